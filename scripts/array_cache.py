@@ -0,0 +1,164 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+import os, threading, contextlib, hashlib, json
+from collections import OrderedDict
+
+
+class MemoryArrayCache(object):
+	''' A thread-safe cache of numpy arrays that drops the least recently
+	    used arrays when their total size exceeds max_bytes '''
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.arrays = OrderedDict()
+		self.total_bytes = 0
+		self.hits, self.misses = 0, 0
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			array = self.arrays.get(key)
+			if array is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self.arrays.move_to_end(key)
+			return(array)
+
+	def put(self, key, array):
+		with self.lock:
+			if key in self.arrays:
+				self.total_bytes -= self.arrays.pop(key).nbytes
+			self.arrays[key] = array
+			self.total_bytes += array.nbytes
+			while self.total_bytes > self.max_bytes and len(self.arrays) > 1:
+				_, evicted = self.arrays.popitem(last=False)
+				self.total_bytes -= evicted.nbytes
+		return
+
+	def stats(self):
+		with self.lock:
+			return({'hits': self.hits,
+					'misses': self.misses,
+					'entries': len(self.arrays),
+					'bytes': self.total_bytes})
+
+
+class DiskArrayCache(object):
+	''' A cache of numpy arrays stored as .npy files in a directory, which
+	    persists between runs. Files are written atomically, and when their
+	    total size exceeds max_bytes the least recently used (by
+	    modification time, which is updated on each read) are removed. '''
+	def __init__(self, cache_dir, max_bytes):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		os.makedirs(cache_dir, exist_ok=True)
+		self.total_bytes = sum(size for _, size, _ in self.cached_files())
+		self.hits, self.misses = 0, 0
+		self.lock = threading.Lock()
+
+	def filename(self, key):
+		return(os.path.join(self.cache_dir, '{}.npy'.format(key)))
+
+	def get(self, key):
+		try:
+			array = np.load(self.filename(key))
+			os.utime(self.filename(key))
+		except (OSError, ValueError):
+			array = None
+		with self.lock:
+			if array is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+		return(array)
+
+	def put(self, key, array):
+		filename = self.filename(key)
+		temp_filename = filename + '.tmp{}_{}'.format(os.getpid(),
+													 threading.get_ident())
+		with open(temp_filename, 'wb') as f:
+			np.save(f, array)
+		size = os.path.getsize(temp_filename)
+		with self.lock:
+			with contextlib.suppress(OSError):
+				self.total_bytes -= os.path.getsize(filename)
+			os.replace(temp_filename, filename)
+			self.total_bytes += size
+			if self.total_bytes > self.max_bytes:
+				self.evict(exclude=filename)
+		return
+
+	def cached_files(self):
+		''' (last use time, size in bytes, filename) of each cached array '''
+		files = []
+		for name in os.listdir(self.cache_dir):
+			if not name.endswith('.npy'):
+				continue
+			filename = os.path.join(self.cache_dir, name)
+			with contextlib.suppress(OSError):
+				files.append((os.path.getmtime(filename),
+							  os.path.getsize(filename), filename))
+		return(sorted(files))
+
+	def evict(self, exclude):
+		''' Remove least recently used files until the cache fits the budget.
+		    Must be called with the lock held. '''
+		# Evict down to 90% of the budget, so that the directory isn't
+		# scanned again on the next put
+		files = self.cached_files()
+		self.total_bytes = sum(size for _, size, _ in files)
+		for _, size, filename in files:
+			if self.total_bytes <= 0.9 * self.max_bytes:
+				break
+			if filename == exclude:
+				continue
+			with contextlib.suppress(OSError):
+				os.remove(filename)
+				self.total_bytes -= size
+		return
+
+	def stats(self):
+		with self.lock:
+			return({'hits': self.hits,
+					'misses': self.misses,
+					'bytes': self.total_bytes})
+
+
+def file_digest(filename):
+	digest = hashlib.md5()
+	with open(filename, 'rb') as f:
+		for block in iter(lambda: f.read(2**20), b''):
+			digest.update(block)
+	return(digest.hexdigest())
+
+
+class PredictionCache(object):
+	''' Model scores for input windows, stored on disk as float16 under a
+	    hash of each window's contents. Entries are grouped by a hash of the
+	    model file's contents and the window size and padding, so predictions
+	    are never reused after the model or tiling changes. '''
+	def __init__(self, cache_dir, model_filename, window_dim, padding,
+		max_bytes):
+		key = hashlib.md5(json.dumps([file_digest(model_filename), window_dim,
+			padding]).encode()).hexdigest()[:16]
+		self.cache = DiskArrayCache(os.path.join(cache_dir, key), max_bytes)
+
+	def key(self, window):
+		return(hashlib.sha1(np.ascontiguousarray(window).tobytes()).hexdigest())
+
+	def get(self, window):
+		scores = self.cache.get(self.key(window))
+		return(None if scores is None else scores.astype(np.float32))
+
+	def put(self, window, scores):
+		self.cache.put(self.key(window), scores.astype(np.float16))
+		return
+
+	def counts(self):
+		stats = self.cache.stats()
+		return(stats['hits'], stats['misses'])
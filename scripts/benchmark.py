@@ -0,0 +1,407 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+import os, sys, argparse, time, json, subprocess, tempfile
+import evaluate
+
+
+def record_result(results_filename, benchmark, config, metrics):
+	''' Print a benchmark result and append it to a JSON lines file '''
+	result = {'benchmark': benchmark,
+			  'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			  'config': config,
+			  'metrics': metrics}
+	print(json.dumps(result))
+	if results_filename is not None:
+		with open(results_filename, 'a') as f:
+			f.write(json.dumps(result) + '\n')
+	return
+
+
+def time_call(fn, repeats):
+	''' Return the best wall-clock time of several calls to fn '''
+	durations = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		fn()
+		durations.append(time.perf_counter() - start)
+	return(min(durations))
+
+
+def benchmark_eval(model_filename, region_dim, batch_sizes, repeats,
+	window_dims=None):
+	''' Compare windowed inference at several batch sizes. A batch size of one
+	    is equivalent to the original per-window evaluation loop. Then compare
+	    window sizes at the largest batch size; larger windows overlap less,
+	    so fewer pixels pass through the model. '''
+	model = evaluate.load_model(model_filename)
+	padding = evaluate.TilingPlan.for_model(model).padding
+	naip_image = np.random.randint(0, 256, size=(4, region_dim + 2 * padding,
+		region_dim + 2 * padding)).astype(np.float32) / 256.0
+
+	# Warm up the model so that one-time initialization isn't timed
+	evaluate.predict_windows(model, naip_image, max(batch_sizes))
+
+	baseline = None
+	for batch_size in batch_sizes:
+		duration = time_call(lambda: evaluate.predict_windows(
+			model, naip_image, batch_size), repeats)
+		if baseline is None:
+			baseline = duration
+		print('eval region_dim={} batch_size={}: {:.3f} s ({:.2f}x)'.format(
+			region_dim, batch_size, duration, baseline / duration))
+
+	for window_dim in window_dims or []:
+		model = evaluate.load_model(model_filename, window_dim, padding)
+		plan = evaluate.TilingPlan.for_model(model)
+		evaluate.predict_windows(model, naip_image, max(batch_sizes))
+		duration = time_call(lambda: evaluate.predict_windows(
+			model, naip_image, max(batch_sizes)), repeats)
+		print('eval region_dim={} window_dim={} overlap={:.2f}x: {:.3f} s '
+			  '({:.2f}x)'.format(region_dim, window_dim,
+			  plan.overlap(region_dim, region_dim), duration,
+			  baseline / duration))
+	return
+
+
+def write_tile(filename, image):
+	''' Write a synthetic tile with LZW compression, as the NAIP and
+	    LandCover tiles are. Encoding LZW needs a recent tifffile with the
+	    imagecodecs package; without them the tile is deflate-compressed
+	    instead, which decodes at a different speed. Returns the compression
+	    used. '''
+	import tifffile
+	try:
+		tifffile.imwrite(filename, image, compression='lzw')
+		return('lzw')
+	except (AttributeError, TypeError, KeyError, ValueError):
+		pass
+	try:
+		tifffile.imwrite(filename, image, compression='zlib')
+	except (AttributeError, TypeError):
+		# Older tifffile versions take a compress level
+		tifffile.imsave(filename, image, compress=6)
+	return('deflate')
+
+
+def make_synthetic_tiles(output_dir, num_tiles, tile_dim, seed=0):
+	''' Write NAIP/LandCover TIF pairs resembling the training data: 4-band
+	    uint8 imagery, and uint8 labels (including values above 4, which
+	    are folded into class 4) in patches of uniform cover. Returns the
+	    compression used (see write_tile). '''
+	rng = np.random.RandomState(seed)
+	os.makedirs(output_dir, exist_ok=True)
+	for tile_idx in range(num_tiles):
+		tile_name = os.path.join(output_dir, 'synthetic{}'.format(tile_idx))
+		naip_image = rng.randint(0, 256, size=(tile_dim, tile_dim, 4)).astype(
+			np.uint8)
+		coarse_labels = rng.choice([1, 2, 3, 4, 5], p=[0.05, 0.5, 0.35, 0.05,
+			0.05], size=(tile_dim // 64 + 1, tile_dim // 64 + 1))
+		landcover_image = np.repeat(np.repeat(coarse_labels, 64, axis=0), 64,
+			axis=1)[:tile_dim, :tile_dim].astype(np.uint8)
+		compression = write_tile('{}_NAIP.tif'.format(tile_name), naip_image)
+		write_tile('{}_LandCover.tif'.format(tile_name), landcover_image)
+	if compression != 'lzw':
+		print('Synthetic tiles are {}-compressed, since LZW could not be '
+			  'encoded; real NAIP tiles are LZW-compressed, so their decode '
+			  'times will differ'.format(compression))
+	return(compression)
+
+
+def network_config(args):
+	return({'block_size': args.block_size,
+			'num_stack_layers': args.num_stack_layers,
+			'c_map': args.c_map})
+
+
+def benchmark_data_source(input_dir, args):
+	''' Measure the samples per second produced by MyDataSource on one
+	    worker, after its tiles have been loaded '''
+	import train_distributed
+	block_size = args.block_size
+	minibatch_source = train_distributed.MyDataSource(
+		(4, block_size, block_size), (5, block_size, block_size), 1, input_dir,
+		160, args.prefetch_depth, args.prefetch_threads)
+	minibatch_source.next_minibatch(args.minibatch_size)
+	start = time.perf_counter()
+	for _ in range(args.num_minibatches):
+		minibatch_source.next_minibatch(args.minibatch_size)
+	duration = time.perf_counter() - start
+	record_result(args.results_file, 'data_source',
+		dict(network_config(args), tile_compression=args.tile_compression,
+			 prefetch_depth=args.prefetch_depth,
+			 prefetch_threads=args.prefetch_threads,
+			 minibatch_size=args.minibatch_size),
+		{'samples_per_second':
+		 args.num_minibatches * args.minibatch_size / duration})
+	return
+
+
+def benchmark_model_step(args):
+	''' Measure the time for one training step of the network on random
+	    data '''
+	import cntk, train_distributed
+	feature, label, model, output, mean_ce, pe = \
+		train_distributed.build_network(5, 4, args.block_size,
+										args.num_stack_layers, args.c_map)
+	learner = train_distributed.create_learner(model, args.minibatch_size,
+		args.minibatch_size * args.num_minibatches)
+	trainer = cntk.Trainer(output, (mean_ce, pe), learner)
+	features = np.random.rand(args.minibatch_size,
+		*feature.shape).astype(np.float32)
+	labels = np.transpose(np.eye(5, dtype=np.float32)[np.random.randint(
+		0, 5, size=(args.minibatch_size,) + label.shape[1:])], (0, 3, 1, 2))
+	data = {feature: features, label: np.ascontiguousarray(labels)}
+	trainer.train_minibatch(data)
+	step_seconds = time_call(lambda: trainer.train_minibatch(data),
+							 args.num_minibatches)
+	record_result(args.results_file, 'model_step',
+		dict(network_config(args), minibatch_size=args.minibatch_size),
+		{'step_seconds': step_seconds,
+		 'samples_per_second': args.minibatch_size / step_seconds,
+		 'num_parameters': int(sum(p.value.size for p in model.parameters))})
+	return
+
+
+def distribution_config(args, distribution):
+	return({'distribution': distribution,
+			'quantization_bits': args.quantization_bits
+			if distribution == 'data_parallel' else 32,
+			'sync_period': args.sync_period,
+			'accumulation_steps': args.accumulation_steps,
+			'lr_scaling': args.lr_scaling})
+
+
+def benchmark_epochs(input_dir, args):
+	''' Measure the duration of a short training epoch for each worker count
+	    and distribution strategy, launching the workers as local MPI
+	    processes. The epoch is timed from the first minibatch on; the
+	    time taken to start up (building the network and loading the first
+	    tiles) is reported separately. '''
+	for num_workers in args.workers:
+		for distribution in args.distributions:
+			config = distribution_config(args, distribution)
+			with tempfile.TemporaryDirectory() as model_dir:
+				command = ['mpiexec', '-n', str(num_workers), sys.executable,
+						   os.path.abspath(__file__), 'epoch',
+						   '--input_dir', input_dir, '--model_dir', model_dir,
+						   '--block_size', str(args.block_size),
+						   '--num_stack_layers', str(args.num_stack_layers),
+						   '--minibatches_per_epoch',
+						   str(args.minibatches_per_epoch),
+						   '--c_map'] + [str(c) for c in args.c_map]
+				for name, value in sorted(config.items()):
+					command += ['--' + name, str(value)]
+				output = subprocess.check_output(command,
+												 universal_newlines=True)
+			durations = [json.loads(line) for line in output.splitlines()
+						 if line.startswith('{"epoch_seconds"')]
+			record_result(args.results_file, 'epoch',
+				dict(network_config(args),
+					 tile_compression=args.tile_compression,
+					 num_workers=num_workers,
+					 minibatches_per_epoch=args.minibatches_per_epoch,
+					 **config),
+				durations[0])
+	return
+
+
+def run_epoch(args):
+	''' Train for one short epoch; run on each MPI worker by benchmark_epochs.
+	    Rank 0 prints the epoch and startup times as JSON. '''
+	import train_distributed
+	rank = train_distributed.distributed.Communicator.rank()
+	timings = train_distributed.train(args.input_dir, args.model_dir, 1,
+		block_size=args.block_size, num_stack_layers=args.num_stack_layers,
+		c_map=args.c_map, minibatches_per_epoch=args.minibatches_per_epoch,
+		**distribution_config(args, args.distribution))
+	if rank == 0:
+		print(json.dumps({'epoch_seconds': timings['training_seconds'],
+						  'startup_seconds': timings['startup_seconds']}))
+	return
+
+
+def benchmark_train(args):
+	''' Run the data source, model step and epoch benchmarks on synthetic
+	    tiles '''
+	with tempfile.TemporaryDirectory() as input_dir:
+		args.tile_compression = make_synthetic_tiles(input_dir,
+			args.num_tiles, args.tile_dim)
+		benchmark_data_source(input_dir, args)
+		benchmark_model_step(args)
+		benchmark_epochs(input_dir, args)
+	return
+
+
+def import_times(module, script_dir):
+	''' Import a module in a fresh interpreter with -X importtime. Returns
+	    the total time in seconds and the slowest of the module's own imports
+	    as (seconds, name), each including its nested imports. '''
+	result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+							 'import {}'.format(module)], cwd=script_dir,
+							stderr=subprocess.PIPE, universal_newlines=True)
+	if result.returncode != 0:
+		raise RuntimeError('Could not import {}:\n{}'.format(module,
+															  result.stderr))
+	# Lines read "import time: self [us] | cumulative | imported package",
+	# with nested imports indented and listed before the importing module
+	direct_imports = []
+	for line in result.stderr.splitlines():
+		fields = line.split('|')
+		if not line.startswith('import time:') or \
+			not fields[1].strip().isdigit():
+			continue
+		seconds, name = int(fields[1]) / 1e6, fields[2][1:].rstrip()
+		if name.strip() == module:
+			return(seconds, sorted(direct_imports, reverse=True)[:10])
+		if not name.startswith('  '):
+			direct_imports = []
+		elif not name.startswith('   '):
+			direct_imports.append((seconds, name.strip()))
+	raise RuntimeError('No import time was reported for {}'.format(module))
+
+
+def benchmark_startup(modules, repeats, results_filename):
+	''' Measure how long each entry point takes to import, and to start up
+	    far enough to print its --help text '''
+	script_dir = os.path.dirname(os.path.abspath(__file__))
+	for module in modules:
+		import_seconds, slowest = min(import_times(module, script_dir)
+									  for _ in range(repeats))
+		help_seconds = time_call(lambda: subprocess.check_output(
+			[sys.executable, os.path.join(script_dir, module + '.py'),
+			 '--help'], cwd=script_dir), repeats)
+		record_result(results_filename, 'startup', {'module': module},
+			{'import_seconds': import_seconds,
+			 'help_seconds': help_seconds,
+			 'slowest_imports': [{'module': name, 'seconds': seconds}
+								 for seconds, name in slowest]})
+	return
+
+
+def add_network_arguments(parser):
+	parser.add_argument('--block_size', type=int, required=False, default=256,
+						help='Side length of the training patches')
+	parser.add_argument('--num_stack_layers', type=int, required=False,
+						default=2, help='Residual blocks per stage')
+	parser.add_argument('--c_map', type=int, nargs=4, required=False,
+						default=[64, 32, 32, 32],
+						help='Number of filters in each stage')
+	return
+
+
+def add_distribution_arguments(parser):
+	parser.add_argument('--quantization_bits', type=int, required=False,
+						default=32,
+						help='Bits per gradient value with data_parallel ' +
+						'distribution')
+	parser.add_argument('--sync_period', type=int, required=False, default=8,
+						help='Minibatches between parameter exchanges with ' +
+						'block_momentum or local_sgd distribution')
+	parser.add_argument('--accumulation_steps', type=int, required=False,
+						default=1,
+						help='Multiple of 10 samples per worker per step')
+	parser.add_argument('--lr_scaling', type=str, required=False,
+						default='linear', choices=['linear', 'sqrt', 'none'])
+	return
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='''
+Benchmarks the evaluation and training pipelines on synthetic data.
+''')
+	subparsers = parser.add_subparsers(dest='command')
+
+	eval_parser = subparsers.add_parser('eval',
+		help='Compare per-window and batched windowed inference')
+	eval_parser.add_argument('-m', '--model_filename', type=str, required=True,
+							 help='Filepath to the trained model')
+	eval_parser.add_argument('-r', '--region_dim', type=int, required=False,
+							 default=1024,
+							 help='The side length of the ROI in pixels')
+	eval_parser.add_argument('-b', '--batch_sizes', type=int, nargs='+',
+							 required=False, default=[1, 4, 16, 64],
+							 help='Batch sizes to compare (first is baseline)')
+	eval_parser.add_argument('--repeats', type=int, required=False, default=3,
+							 help='Number of timed repetitions per setting')
+	eval_parser.add_argument('-w', '--window_dims', type=int, nargs='+',
+							 required=False, default=[512, 1152],
+							 help='Window sizes to compare, with the padding ' +
+							 'the model was trained with')
+
+	train_parser = subparsers.add_parser('train',
+		help='Measure data source throughput, model step time and epoch ' +
+		'duration for 1..N local workers on synthetic tiles')
+	add_network_arguments(train_parser)
+	train_parser.add_argument('--num_tiles', type=int, required=False,
+							  default=4, help='Number of synthetic tile pairs')
+	train_parser.add_argument('--tile_dim', type=int, required=False,
+							  default=2048,
+							  help='Side length of the synthetic tiles')
+	train_parser.add_argument('--minibatch_size', type=int, required=False,
+							  default=10)
+	train_parser.add_argument('--num_minibatches', type=int, required=False,
+							  default=20,
+							  help='Minibatches timed for data source and ' +
+							  'model step benchmarks')
+	train_parser.add_argument('--minibatches_per_epoch', type=int,
+							  required=False, default=20,
+							  help='Length of the timed training epoch')
+	train_parser.add_argument('--prefetch_depth', type=int, required=False,
+							  default=4)
+	train_parser.add_argument('--prefetch_threads', type=int, required=False,
+							  default=2)
+	train_parser.add_argument('-w', '--workers', type=int, nargs='+',
+							  required=False, default=[1, 2],
+							  help='Worker counts to time epochs for')
+	train_parser.add_argument('--distributions', type=str, nargs='+',
+							  required=False, default=['data_parallel'],
+							  choices=['data_parallel', 'block_momentum',
+									   'local_sgd'],
+							  help='Distribution strategies to time epochs ' +
+							  'for')
+	add_distribution_arguments(train_parser)
+	train_parser.add_argument('--results_file', type=str, required=False,
+							  default='benchmark_results.jsonl',
+							  help='JSON lines file to append results to')
+
+	startup_parser = subparsers.add_parser('startup',
+		help='Measure import and startup time of the entry points')
+	startup_parser.add_argument('--modules', type=str, nargs='+',
+								required=False,
+								default=['evaluate', 'train_distributed'],
+								help='Scripts to import and start')
+	startup_parser.add_argument('--repeats', type=int, required=False,
+								default=3,
+								help='Number of timed repetitions per script')
+	startup_parser.add_argument('--results_file', type=str, required=False,
+								default='benchmark_results.jsonl',
+								help='JSON lines file to append results to')
+
+	epoch_parser = subparsers.add_parser('epoch',
+		help='Train for one epoch (used internally by the train benchmark)')
+	add_network_arguments(epoch_parser)
+	epoch_parser.add_argument('--input_dir', type=str, required=True)
+	epoch_parser.add_argument('--model_dir', type=str, required=True)
+	epoch_parser.add_argument('--minibatches_per_epoch', type=int,
+							  required=False, default=20)
+	epoch_parser.add_argument('--distribution', type=str, required=False,
+							  default='data_parallel')
+	add_distribution_arguments(epoch_parser)
+
+	args = parser.parse_args()
+	if args.command == 'eval':
+		benchmark_eval(args.model_filename, args.region_dim, args.batch_sizes,
+					   args.repeats, args.window_dims)
+	elif args.command == 'train':
+		benchmark_train(args)
+	elif args.command == 'startup':
+		benchmark_startup(args.modules, args.repeats, args.results_file)
+	elif args.command == 'epoch':
+		run_epoch(args)
+	else:
+		parser.print_help()
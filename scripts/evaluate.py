@@ -6,13 +6,17 @@
 # ==============================================================================
 
 import numpy as np
-import pandas as pd
-import os, argparse, cntk, tifffile, warnings, osr
-from osgeo import gdal
-from gdalconst import *
-from mpl_toolkits.basemap import Basemap
-from collections import namedtuple
-from PIL import Image
+import os, argparse, csv, json, multiprocessing
+from metrics import ConfusionAccumulator
+from tiling import TilingPlan, crop_window, resu_receptive_field
+from tile_index import TileIndex, Mosaic, latlon_transform
+from array_cache import PredictionCache
+from raster_io import read_image_pair, raster_size, clip_window, \
+	read_dataset, prepare_naip, prepare_landcover, naip_scale
+
+# CNTK, GDAL and tifffile take a while to import, so they are imported by the
+# functions that use them; starting a job (or printing --help) only pays for
+# what it needs.
 
 
 # Maps land use labels to colors
@@ -23,126 +27,681 @@ color_map = np.asarray([[0,0,0],
 						[0.5,0.375,0.375]], dtype=np.float32)
 
 
-def load_image_pair(tile_name):
-	''' Load the corresponding NAIP and LandCover images '''
-	#with warnings.filterwarnings('ignore'):
-	# With the currently-available training data, the tifffile package
-	# generates these RuntimeWarnings and UserWarnings under normal
-	# operating conditions:
-	# - RuntimeWarning: py_decodelzw encountered unexpected end of stream
-	# - UserWarning: unpack: string size must be a multiple of element size
-	# - UserWarning: invalid tile data
-	with warnings.catch_warnings():
-		warnings.simplefilter('ignore')
-		naip_image = np.transpose(tifffile.imread(
-			'{}_NAIP.tif'.format(tile_name)))  / 256.0
-		landcover_image = np.transpose(tifffile.imread(
-			'{}_LandCover.tif'.format(tile_name)))
-	landcover_image[landcover_image > 4] = 4
-	return (naip_image, landcover_image)
+class Georeferencer(object):
+	''' Maps latitude/longitude coordinates to pixel indices in a raster. The
+	    geotransform and coordinate transformation are read once, so arrays of
+	    points can be located with a single call. '''
+	def __init__(self, img_filename):
+		from osgeo import gdal
+		img = gdal.Open(img_filename, gdal.GA_ReadOnly)
+		self.projection = img.GetProjection()
+		self.geotransform = img.GetGeoTransform()
+		self.ulcrnrx, self.xstep, _, self.ulcrnry, _, self.ystep = \
+			self.geotransform
+		# The same transformation as the tile index's, with both spatial
+		# references in traditional (lon, lat) / (x, y) axis order
+		self.ct_to_img = latlon_transform(self.projection)
+
+	def pixels_from_latlon(self, lats, lons):
+		''' Find the (x, y) pixel indices for arrays of points '''
+		lats, lons = np.atleast_1d(lats, lons)
+		points = np.asarray(self.ct_to_img.TransformPoints(
+			np.stack([lons, lats], axis=1).astype(np.float64).tolist()))
+		x = np.floor((points[:, 0] - self.ulcrnrx) / self.xstep).astype(int)
+		y = np.floor((points[:, 1] - self.ulcrnry) / self.ystep).astype(int)
+		return(x, y)
+
+	def georeference(self, x, y):
+		''' The (geotransform, projection) of a window whose upper-left
+		    pixel is (x, y) in this raster '''
+		return(shift_geotransform(self.geotransform, x, y), self.projection)
+
+
+def shift_geotransform(geotransform, x, y):
+	''' The geotransform of a window whose upper-left pixel is (x, y) '''
+	ulcrnrx, xstep, xrot, ulcrnry, yrot, ystep = geotransform
+	return((ulcrnrx + x * xstep + y * xrot, xstep, xrot,
+			ulcrnry + x * yrot + y * ystep, yrot, ystep))
+
+
+georeferencers = {}
+
+
+def get_georeferencer(img_filename):
+	''' Return the (cached) Georeferencer for a raster '''
+	if img_filename not in georeferencers:
+		georeferencers[img_filename] = Georeferencer(img_filename)
+	return(georeferencers[img_filename])
 
 
 def find_pixel_from_latlon(img_filename, lat, lon):
 	''' Find the indices for a point of interest '''
-	img = gdal.Open(img_filename, GA_ReadOnly)
-	img_proj = osr.SpatialReference()
-	img_proj.ImportFromWkt(img.GetProjection())
-	ulcrnrx, xstep, _, ulcrnry, _, ystep = img.GetGeoTransform()
-
-	world_map = Basemap(lat_0=0,
-						lon_0=0,
-						llcrnrlat=-90, urcrnrlat=90,
-						llcrnrlon=-180, urcrnrlon=180,
-						resolution='c', projection='stere')
-	world_proj = osr.SpatialReference()
-	world_proj.ImportFromProj4(world_map.proj4string)
-	ct_to_img = osr.CoordinateTransformation(world_proj, img_proj)
-	
-	xpos, ypos = world_map(lon, lat, inverse=False)
-	xpos, ypos, _ = ct_to_img.TransformPoint(xpos, ypos)
-	x = int((xpos - ulcrnrx) / xstep)
-	y = int((ypos - ulcrnry) / ystep)
-
-	return(x,y)
-
-
-def save_naip_image(input_image, output_filename):
-	#color_last = np.round(np.transpose(input_image, (1, 2, 0)) * 255, 0) \
-	#		.astype(np.uint8)
-	color_last = np.transpose(input_image)
-	tifffile.imsave(output_filename, color_last)
+	x, y = get_georeferencer(img_filename).pixels_from_latlon(lat, lon)
+	return(int(x[0]), int(y[0]))
+
+
+def write_geotiff(image, output_filename, georeference, color_table=None):
+	''' Write a uint8 image (rows x columns, with an optional trailing band
+	    axis) as a tiled, compressed GeoTIFF. georeference is a
+	    (geotransform, projection) pair, and a color table can be attached to
+	    single-band images. '''
+	from osgeo import gdal
+	if image.ndim == 2:
+		image = image[:, :, np.newaxis]
+	height, width, num_bands = image.shape
+	dataset = gdal.GetDriverByName('GTiff').Create(output_filename, width,
+		height, num_bands, gdal.GDT_Byte,
+		options=['TILED=YES', 'COMPRESS=DEFLATE'] +
+		(['PHOTOMETRIC=RGB'] if num_bands == 3 else []))
+	if georeference is not None:
+		dataset.SetGeoTransform(georeference[0])
+		dataset.SetProjection(georeference[1])
+	for band_idx in range(num_bands):
+		band = dataset.GetRasterBand(band_idx + 1)
+		band.WriteArray(image[:, :, band_idx])
+		if color_table is not None:
+			band.SetColorTable(color_table)
+	dataset.FlushCache()
 	return
 
 
-def save_label_image(input_image, output_filename, hard=True):
-	num_labels, height, width = input_image.shape
-	label_image = np.zeros((3, height, width))
-	if hard:
-		my_label_indices = input_image.argmax(axis=0)
-		for label_idx in range(num_labels):
-			for rgb_idx in range(3):
-				label_image[rgb_idx, :, :] += (my_label_indices == label_idx) *\
-					color_map[label_idx, rgb_idx]
+def label_color_table():
+	''' A GDAL color table matching color_map, for paletted label images '''
+	from osgeo import gdal
+	color_table = gdal.ColorTable()
+	for label_idx, color in enumerate(np.round(color_map * 255).astype(int)):
+		color_table.SetColorEntry(label_idx, tuple(color.tolist()) + (255,))
+	return(color_table)
+
+
+def save_naip_image(input_image, output_filename, output_format='rgb',
+	georeference=None):
+	''' Save NAIP imagery (scaled by naip_scale) as uint8 '''
+	color_last = np.clip(np.round(np.transpose(input_image) / naip_scale), 0,
+						 255).astype(np.uint8)
+	if output_format == 'rgb':
+		import tifffile
+		tifffile.imsave(output_filename, color_last)
 	else:
-		input_image = np.exp(input_image) / np.sum(np.exp(input_image), axis=0)
-		for label_idx in range(num_labels):
-			for rgb_idx in range(3):
-				label_image[rgb_idx, :, :] += input_image[label_idx, :, :] * \
-					color_map[label_idx, rgb_idx]
-	label_image = np.transpose(label_image).astype(np.float32)
-	tifffile.imsave(output_filename, label_image)
+		write_geotiff(color_last, output_filename, georeference)
 	return
 
 
-def eval(input_filename, model_filename, output_dir, center_lat, center_lon,
-	region_dim):
-	''' Coordinates model evaluation '''
+def colorize_labels(input_image, hard=True):
+	''' Convert per-label scores (num_labels x height x width) or label
+	    indices (height x width) to a uint8 RGB image, transposed to
+	    rows x columns x 3 like the input TIFFs. Soft coloring blends the
+	    label colors weighted by the softmax of the scores. '''
+	if input_image.ndim == 2 or hard:
+		if input_image.ndim == 3:
+			input_image = input_image.argmax(axis=0)
+		label_image = color_map[np.transpose(input_image).astype(np.intp)]
+	else:
+		probs = np.exp(input_image - input_image.max(axis=0))
+		probs /= probs.sum(axis=0)
+		label_image = np.tensordot(np.transpose(probs, (2, 1, 0)), color_map,
+								   axes=([2], [0]))
+	return(np.round(label_image * 255).astype(np.uint8))
+
+
+def save_label_image(input_image, output_filename, hard=True,
+	output_format='rgb', georeference=None):
+	''' Save per-label scores or label indices as an image. Formats are
+	    'rgb' (a uint8 RGB TIFF), 'geotiff' (the same as a tiled, compressed
+	    GeoTIFF) and 'paletted' (a single-band GeoTIFF of label indices with a
+	    color table; soft coloring isn't possible in this format). '''
+	if output_format == 'paletted':
+		if input_image.ndim == 3:
+			input_image = input_image.argmax(axis=0)
+		write_geotiff(np.transpose(input_image).astype(np.uint8),
+					  output_filename, georeference, label_color_table())
+	elif output_format == 'geotiff':
+		write_geotiff(colorize_labels(input_image, hard), output_filename,
+					  georeference)
+	else:
+		import tifffile
+		tifffile.imsave(output_filename, colorize_labels(input_image, hard))
+	return
+
+
+def load_model(model_filename, window_dim=None, padding=None,
+	num_stack_layers=2, c_map=(64, 32, 32, 32)):
+	''' Load a trained model, optionally for a different window size or
+	    padding than it was trained with. The network is fully convolutional
+	    apart from the output shapes of its upsampling layers and the final
+	    crop, so it is rebuilt (with the architecture it was trained with) for
+	    window_dim-pixel windows whose central window_dim - 2 * padding pixels
+	    are kept, and the trained weights are copied into it. Each window's
+	    mean color is subtracted by the network, so predictions from windows
+	    of different sizes can differ slightly. Raises ValueError if the
+	    padding is less than half of the network's receptive field. '''
+	import cntk
 	model = cntk.load_model(model_filename)
-	naip_image, true_lc_image = load_image_pair(
-		input_filename.replace('_NAIP.tif', ''))
-	
-	# Crop the input image and its true labels to the ROI. Include padding on
-	# the NAIP image so that we have enough info to label the whole ROI.
-	delta = int(region_dim / 2)
-	padding = 64
-	
-	center_x, center_y = find_pixel_from_latlon(input_filename, center_lat,
-		center_lon)
-	true_lc_image = true_lc_image[center_x - delta:center_x + delta,
-		center_y - delta:center_y + delta].astype(np.float32)
-	naip_image = naip_image[:,
-		center_x - (delta + padding):center_x + delta + padding,
-		center_y - (delta + padding):center_y + delta + padding].astype(
-			np.float32)
-
-	# Iterate over the squares
-	n_rows = int(region_dim / 128) # = n_cols, since the region is square
-	pred_lc_image = np.zeros((5, true_lc_image.shape[0],
-		true_lc_image.shape[1]))
-	for row_idx in range(n_rows):
-		for col_idx in range(n_rows):
-			# Extract a 256 x 256 region from the NAIP image, to feed into the
-			# model.
-			sq_naip = naip_image[:,
-								 row_idx * 128:(row_idx * 128) + 256,
-								 col_idx * 128:(col_idx * 128) + 256]
-			sq_pred_lc = np.squeeze(model.eval({model.arguments[0]: [sq_naip]}))
-			pred_lc_image[:,
-						  row_idx * 128:(row_idx * 128) + 128,
-						  col_idx * 128:(col_idx * 128) + 128] = sq_pred_lc
-	
-	# Save the extracted images in human-viewable form. Will drop the near-
-	# infrared channel from the NAIP imagery so that it won't wind up being
-	# rendered as transparency. Note that the true labels must be expanded up
-	# to one-hot before using the same function to save them.
-	save_naip_image(naip_image[:3, padding:-padding, padding:-padding],
-                    os.path.join(output_dir, 'NAIP.tif'))
+	trained_plan = TilingPlan.for_model(model)
+	window_dim = window_dim or trained_plan.window_dim
+	padding = trained_plan.padding if padding is None else padding
+	plan = TilingPlan(window_dim, padding,
+					  resu_receptive_field(num_stack_layers))
+	if (plan.window_dim, plan.output_dim) == (trained_plan.window_dim,
+											  trained_plan.output_dim):
+		return(model)
+	if window_dim % 8 != 0:
+		raise ValueError('The window dimension must be divisible by 8.')
+	import model_mini_pub
+
+	num_classes = model.output.shape[0]
+	num_channels = model.arguments[0].shape[0]
+	feature = cntk.input_variable((num_channels, window_dim, window_dim),
+								  np.float32)
+	network = cntk.reshape(model_mini_pub.model(num_classes, window_dim,
+		num_stack_layers, c_map)(feature), (num_classes, window_dim,
+											window_dim))
+	output = cntk.slice(cntk.slice(network, 1, padding, window_dim - padding),
+						2, padding, window_dim - padding)
+	trained = model.parameters + model.constants
+	rebuilt = output.parameters + output.constants
+	if [v.shape for v in trained] != [v.shape for v in rebuilt]:
+		raise ValueError('The model in {} does not match the network '
+						 'architecture.'.format(model_filename))
+	return(output.clone(cntk.CloneMethod.freeze,
+						dict((new, cntk.constant(old.value))
+							 for new, old in zip(rebuilt, trained))))
+
+
+def open_prediction_cache(cache_dir, cache_gb, model_filename, model):
+	''' A PredictionCache for the model, or None if cache_dir is None '''
+	if cache_dir is None:
+		return(None)
+	plan = TilingPlan.for_model(model)
+	return(PredictionCache(cache_dir, model_filename, plan.window_dim,
+						   plan.padding, int(cache_gb * 2**30)))
+
+
+def evaluate_windows(model, batch, cache=None):
+	''' The model's scores (num_windows x num_classes x output_dim x
+	    output_dim) for a batch of windows. With a PredictionCache, only
+	    windows that are not in the cache are passed to the model. '''
+	num_classes, output_dim, _ = model.output.shape
+	if cache is None:
+		return(np.asarray(model.eval({model.arguments[0]: batch})).reshape(
+			(len(batch), num_classes, output_dim, output_dim)))
+	scores = [cache.get(window) for window in batch]
+	missing = [k for k, s in enumerate(scores) if s is None]
+	if len(missing) > 0:
+		computed = np.asarray(model.eval(
+			{model.arguments[0]: batch[missing]})).reshape(
+			(len(missing), num_classes, output_dim, output_dim))
+		for k, window_scores in zip(missing, computed):
+			cache.put(batch[k], window_scores)
+			scores[k] = window_scores
+	return(np.stack(scores))
+
+
+def print_cache_counts(hits, misses):
+	print('Prediction cache: {} of {} windows reused ({:.1f}%)'.format(
+		hits, hits + misses, 100.0 * hits / max(hits + misses, 1)))
+	return
+
+
+def predict_windows(model, naip_image, batch_size=16, cache=None):
+	''' Apply the model to every window of a NAIP image with the plan's
+	    padding around the region to label, evaluating batch_size windows per
+	    call and stitching the center of each window's prediction into the
+	    output. Regions smaller than the model's output are reflect-padded. '''
+	plan = TilingPlan.for_model(model)
+	num_classes = model.output.shape[0]
+	output_dim, window_dim = plan.output_dim, plan.window_dim
+	num_channels, height, width = naip_image.shape
+	height -= 2 * plan.padding
+	width -= 2 * plan.padding
+	assert height > 0 and width > 0, 'The region to label is empty.'
+	if height < output_dim or width < output_dim:
+		naip_image = crop_window(naip_image, 0, 0,
+			max(height, output_dim) + 2 * plan.padding,
+			max(width, output_dim) + 2 * plan.padding)
+
+	offsets = plan.offsets(height, width)
+	pred_lc_image = np.zeros((num_classes, max(height, output_dim),
+							  max(width, output_dim)), dtype=np.float32)
+	batch = np.zeros((min(batch_size, len(offsets)), num_channels, window_dim,
+					  window_dim), dtype=np.float32)
+	for batch_start in range(0, len(offsets), batch_size):
+		batch_offsets = offsets[batch_start:batch_start + batch_size]
+		for k, (x, y) in enumerate(batch_offsets):
+			batch[k] = naip_image[:, x:x + window_dim, y:y + window_dim]
+		sq_pred_lc = evaluate_windows(model, batch[:len(batch_offsets)], cache)
+		for k, (x, y) in enumerate(batch_offsets):
+			pred_lc_image[:, x:x + output_dim, y:y + output_dim] = \
+				sq_pred_lc[k]
+	return(pred_lc_image[:, :height, :width])
+
+
+def read_naip_window(dataset, x, y, window_dim):
+	''' Read a square window of a NAIP image through GDAL, in the same
+	    channel-first, transposed layout and scaling as read_image_pair. Parts
+	    of the window that fall outside the image are reflect-padded. '''
+	return(prepare_naip(read_dataset(dataset, (x, y, window_dim,
+											   window_dim))))
+
+
+def read_landcover_window(dataset, x, y, window_dim):
+	''' Read a square window of a LandCover image through GDAL, in the same
+	    transposed layout and label grouping as read_image_pair. Parts of the
+	    window that fall outside the image are reflect-padded. '''
+	return(prepare_landcover(read_dataset(dataset, (x, y, window_dim,
+													window_dim))))
+
+
+def stream_window_predictions(model, in_dataset, batch_size=16, region=None,
+	cache=None):
+	''' Apply the model to a whole tile, or to a region (x, y, width,
+	    height) of it, reading padded windows from the GDAL dataset (or
+	    Mosaic) as they are needed. The output squares lie on a grid fixed to
+	    the dataset (see TilingPlan.grid_region); squares reaching past the
+	    region are cropped to it, and windows reaching past the dataset are
+	    reflect-padded. Yields the offset (x, y) of each square within the
+	    region and the model's scores for it (num_classes x width x height,
+	    at most output_dim on a side). Windows are visited in raster row
+	    order so that reads move through the file sequentially. '''
+	plan = TilingPlan.for_model(model)
+	num_classes = model.output.shape[0]
+	output_dim, window_dim = plan.output_dim, plan.window_dim
+	if region is None:
+		region = (0, 0, in_dataset.RasterXSize, in_dataset.RasterYSize)
+	region_x, region_y, width, height = region
+	if width <= 0 or height <= 0:
+		raise ValueError('The region to label is empty.')
+	num_channels = in_dataset.RasterCount
+
+	grid_x, grid_y, grid_width, grid_height = plan.grid_region(*region)
+	offsets = plan.offsets(grid_width, grid_height, row_order=True)
+	batch = np.zeros((min(batch_size, len(offsets)), num_channels, window_dim,
+					  window_dim), dtype=np.float32)
+	for batch_start in range(0, len(offsets), batch_size):
+		batch_offsets = offsets[batch_start:batch_start + batch_size]
+		for k, (x, y) in enumerate(batch_offsets):
+			batch[k] = read_naip_window(in_dataset,
+										grid_x + x - plan.padding,
+										grid_y + y - plan.padding,
+										window_dim)
+		sq_pred_lc = evaluate_windows(model, batch[:len(batch_offsets)], cache)
+		for k, (x, y) in enumerate(batch_offsets):
+			x, y = grid_x + x - region_x, grid_y + y - region_y
+			yield(max(x, 0), max(y, 0),
+				  sq_pred_lc[k][:, max(-x, 0):width - x, max(-y, 0):height - y])
+
+
+def stream_eval(input_filename, model_filename, output_filename,
+	batch_size=16, window_dim=None, padding=None, prediction_cache_dir=None,
+	prediction_cache_gb=10):
+	''' Label a whole tile without loading it into memory. Padded windows are
+	    read from the input as they are needed, and the predicted labels for
+	    each batch are written to a georeferenced single-band GeoTIFF before
+	    the next batch is read. '''
+	from osgeo import gdal
+	model = load_model(model_filename, window_dim, padding)
+	cache = open_prediction_cache(prediction_cache_dir, prediction_cache_gb,
+								  model_filename, model)
+	in_dataset = gdal.Open(input_filename, gdal.GA_ReadOnly)
+	width, height = in_dataset.RasterXSize, in_dataset.RasterYSize
+	print_plan(model, width, height)
+	out_dataset = gdal.GetDriverByName('GTiff').Create(
+		output_filename, width, height, 1, gdal.GDT_Byte,
+		options=['TILED=YES', 'COMPRESS=LZW'])
+	out_dataset.SetGeoTransform(in_dataset.GetGeoTransform())
+	out_dataset.SetProjection(in_dataset.GetProjection())
+	out_band = out_dataset.GetRasterBand(1)
+	out_band.SetColorTable(label_color_table())
+
+	for x, y, sq_pred_lc in stream_window_predictions(model, in_dataset,
+													  batch_size, None, cache):
+		out_band.WriteArray(np.transpose(
+			sq_pred_lc.argmax(axis=0)).astype(np.uint8), x, y)
+
+	out_band.FlushCache()
+	out_dataset = None
+	if cache is not None:
+		print_cache_counts(*cache.counts())
+	return
+
+
+def score_tile(task):
+	''' Accumulate the confusion matrix and log-likelihood for one tile,
+	    window by window '''
+	from osgeo import gdal
+	input_filename, batch_size = task
+	naip_dataset = gdal.Open(input_filename, gdal.GA_ReadOnly)
+	landcover_dataset = gdal.Open(input_filename.replace('_NAIP.tif',
+		'_LandCover.tif'), gdal.GA_ReadOnly)
+	accumulator = ConfusionAccumulator(worker_model.output.shape[0])
+	counts_before = worker_cache_counts()
+	for x, y, sq_pred_lc in stream_window_predictions(worker_model,
+		naip_dataset, batch_size, None, worker_cache):
+		score_window(accumulator, landcover_dataset, x, y, sq_pred_lc)
+	return(input_filename, accumulator, np.subtract(worker_cache_counts(),
+													counts_before))
+
+
+def score_window(accumulator, landcover_dataset, x, y, sq_pred_lc,
+	region_x=0, region_y=0):
+	''' Score the prediction for the output square at (x, y) in a region '''
+	true_lc = prepare_landcover(read_dataset(landcover_dataset,
+		(region_x + x, region_y + y) + sq_pred_lc.shape[1:]))
+	accumulator.update(true_lc, sq_pred_lc)
+	return
+
+
+def evaluate_directory(input_dir, model_filename, output_dir, num_processes,
+	batch_size=16, window_dim=None, padding=None, prediction_cache_dir=None,
+	prediction_cache_gb=10):
+	''' Score the model on every NAIP/LandCover pair in a directory. Tiles are
+	    shared out between a pool of processes, and their partial results are
+	    merged into per-tile and overall metrics, saved to metrics.json. '''
+	tasks = [(os.path.join(input_dir, i), batch_size)
+			 for i in sorted(os.listdir(input_dir)) if i.endswith('_NAIP.tif')]
+	total = None
+	cache_counts = np.zeros(2, dtype=np.int64)
+	results = {'tiles': {}}
+	with multiprocessing.Pool(num_processes, initializer=init_worker,
+							  initargs=(model_filename, window_dim, padding,
+										prediction_cache_dir,
+										prediction_cache_gb)) as pool:
+		for input_filename, accumulator, counts in pool.imap_unordered(
+			score_tile, tasks):
+			results['tiles'][os.path.basename(input_filename)] = \
+				accumulator.summary()
+			print('Scored {}: {:.1f}% correct'.format(input_filename,
+				100 * accumulator.summary()['accuracy']))
+			total = accumulator if total is None else total.merge(accumulator)
+			cache_counts += counts
+	results['overall'] = total.summary()
+	if prediction_cache_dir is not None:
+		results['prediction_cache'] = {'hits': int(cache_counts[0]),
+									   'misses': int(cache_counts[1])}
+		print_cache_counts(*cache_counts)
+	with open(os.path.join(output_dir, 'metrics.json'), 'w') as f:
+		json.dump(results, f, indent=1)
+	print('Overall: {:.1f}% correct, mean IoU {}'.format(
+		100 * results['overall']['accuracy'], results['overall']['mean_iou']))
+	return(results)
+
+
+def mosaic_eval(tile_dir, model_filename, output_dir, bbox=None,
+	center_lat=None, center_lon=None, region_dim=1024, batch_size=16,
+	window_dim=None, padding=None, prediction_cache_dir=None,
+	prediction_cache_gb=10):
+	''' Label a region that may span several tiles in a directory: either a
+	    (min_lat, min_lon, max_lat, max_lon) bounding box, or a square of
+	    region_dim pixels around a center. The tiles are found with the
+	    directory's TileIndex and read as one Mosaic on the grid of the tile
+	    at the region's center, so windows near tile boundaries are padded
+	    with imagery from the neighbouring tiles. Predicted labels are
+	    written window by window to pred_labels.tif; if every tile has a
+	    LandCover pair, the predictions are also scored, and the metrics
+	    saved to metrics.json. '''
+	from osgeo import gdal
+	if bbox is not None:
+		center_lat, center_lon = (bbox[0] + bbox[2]) / 2, \
+			(bbox[1] + bbox[3]) / 2
+	index = TileIndex.for_directory(tile_dir)
+	covering = index.query(center_lat, center_lon, center_lat, center_lon)
+	if len(covering) == 0:
+		raise ValueError('No tile in {} covers ({}, {}).'.format(
+			tile_dir, center_lat, center_lon))
+	naip_mosaic = Mosaic(index.tiles, covering[0])
+	if len(naip_mosaic.skipped) > 0:
+		print('Skipped {} tiles not on the grid of {}'.format(
+			len(naip_mosaic.skipped), covering[0]['name']))
+	if bbox is not None:
+		region = naip_mosaic.region_from_bbox(*bbox)
+		print('The region overlaps {} tiles'.format(len(index.query(*bbox))))
+	else:
+		# As with a bounding box, the region is clipped to the mosaic
+		x, y = naip_mosaic.pixels_from_latlon(center_lat, center_lon)
+		region = clip_window((int(x[0]) - region_dim // 2,
+							  int(y[0]) - region_dim // 2, region_dim,
+							  region_dim), (naip_mosaic.RasterXSize,
+											naip_mosaic.RasterYSize))
+	region_x, region_y, width, height = region
+
+	landcover_mosaic = None
+	if all(os.path.exists(t[0].replace('_NAIP.tif', '_LandCover.tif'))
+		   for t in naip_mosaic.tiles):
+		landcover_mosaic = Mosaic(index.tiles, covering[0], '_LandCover.tif')
+
+	model = load_model(model_filename, window_dim, padding)
+	cache = open_prediction_cache(prediction_cache_dir, prediction_cache_gb,
+								  model_filename, model)
+	print_plan(model, width, height, region_x, region_y)
+	out_dataset = gdal.GetDriverByName('GTiff').Create(
+		os.path.join(output_dir, 'pred_labels.tif'), width, height, 1,
+		gdal.GDT_Byte, options=['TILED=YES', 'COMPRESS=LZW'])
+	out_dataset.SetGeoTransform(shift_geotransform(
+		naip_mosaic.GetGeoTransform(), region_x, region_y))
+	out_dataset.SetProjection(naip_mosaic.GetProjection())
+	out_band = out_dataset.GetRasterBand(1)
+	out_band.SetColorTable(label_color_table())
+
+	accumulator = ConfusionAccumulator(model.output.shape[0])
+	for x, y, sq_pred_lc in stream_window_predictions(model, naip_mosaic,
+													  batch_size, region, cache):
+		out_band.WriteArray(np.transpose(
+			sq_pred_lc.argmax(axis=0)).astype(np.uint8), x, y)
+		if landcover_mosaic is not None:
+			score_window(accumulator, landcover_mosaic, x, y, sq_pred_lc,
+						 region_x, region_y)
+	out_band.FlushCache()
+	out_dataset = None
+	if cache is not None:
+		print_cache_counts(*cache.counts())
+
+	if landcover_mosaic is not None:
+		results = accumulator.summary()
+		with open(os.path.join(output_dir, 'metrics.json'), 'w') as f:
+			json.dump(results, f, indent=1)
+		print('{:.1f}% correct, mean IoU {}'.format(
+			100 * results['accuracy'], results['mean_iou']))
+	return
+
+
+def print_plan(model, height, width, x=0, y=0):
+	plan = TilingPlan.for_model(model)
+	print('Labeling {}x{} pixels with {}-pixel windows and {} pixels of '
+		  'padding ({:.2f}x overlap)'.format(height, width, plan.window_dim,
+		  plan.padding, plan.overlap(height, width, x, y)))
+	return
+
+
+def eval(input_filename, model_filename, output_dir, center_lat, center_lon,
+	region_dim, batch_size=16, output_format='rgb', window_dim=None,
+	padding=None, prediction_cache_dir=None, prediction_cache_gb=10):
+	''' Coordinates model evaluation. If no ROI center is given, the whole
+	    tile is labeled. '''
+	model = load_model(model_filename, window_dim, padding)
+	cache = open_prediction_cache(prediction_cache_dir, prediction_cache_gb,
+								  model_filename, model)
+	plan = TilingPlan.for_model(model)
+	padding = plan.padding
+	tile_name = input_filename.replace('_NAIP.tif', '')
+
+	# The image layout is transposed, so height runs along the raster's x axis
+	if center_lat is None or center_lon is None:
+		# Label the full tile
+		x, y = 0, 0
+		height, width = raster_size(input_filename)
+	else:
+		center_x, center_y = find_pixel_from_latlon(input_filename, center_lat,
+			center_lon)
+		x, y = center_x - region_dim // 2, center_y - region_dim // 2
+		height, width = region_dim, region_dim
+
+	# The windows lie on a grid of output squares fixed to the tile, so that
+	# overlapping ROIs are labeled by identical windows (and can share cached
+	# predictions). Only the part of the tile under the padded grid squares
+	# covering the ROI is decoded.
+	grid_x, grid_y, grid_height, grid_width = plan.grid_region(x, y, height,
+															   width)
+	x_start, y_start, _, _ = window = clip_window(
+		(grid_x - padding, grid_y - padding, grid_height + 2 * padding,
+		 grid_width + 2 * padding), raster_size(input_filename))
+	naip_image, true_lc_image = read_image_pair(tile_name, window, np.float32)
+	georeference = get_georeferencer(input_filename).georeference(x, y)
+
+	# Include padding on the NAIP image so that we have enough info to label
+	# the whole region. Beyond the tile's edges, there is no imagery, so the
+	# padding is filled by reflecting the image at its boundary.
+	true_lc_image = crop_window(true_lc_image, x - x_start, y - y_start,
+								height, width).astype(np.float32)
+	naip_image = crop_window(naip_image, grid_x - x_start - padding,
+							 grid_y - y_start - padding,
+							 grid_height + 2 * padding,
+							 grid_width + 2 * padding)
+
+	print_plan(model, height, width, x, y)
+	pred_lc_image = predict_windows(model, naip_image, batch_size, cache)
+	x_crop, y_crop = x - grid_x, y - grid_y
+	pred_lc_image = pred_lc_image[:, x_crop:x_crop + height,
+								  y_crop:y_crop + width]
+	naip_image = naip_image[:, x_crop:x_crop + height + 2 * padding,
+							y_crop:y_crop + width + 2 * padding]
+	if cache is not None:
+		print_cache_counts(*cache.counts())
+	save_outputs(naip_image, pred_lc_image, true_lc_image, padding, output_dir,
+				 output_format, georeference)
+	return
+
+
+def save_outputs(naip_image, pred_lc_image, true_lc_image, padding,
+	output_dir, output_format='rgb', georeference=None):
+	''' Save the extracted images in human-viewable form. Will drop the near-
+	    infrared channel from the NAIP imagery so that it won't wind up being
+	    rendered as transparency. The true labels are colored directly from
+	    their indices. '''
+	_, height, width = naip_image.shape
+	save_naip_image(naip_image[:3, padding:height - padding,
+							   padding:width - padding],
+                    os.path.join(output_dir, 'NAIP.tif'),
+                    'rgb' if output_format == 'rgb' else 'geotiff',
+                    georeference)
 	save_label_image(pred_lc_image, os.path.join(output_dir, 'pred_labels.tif'),
-		hard=True)
+		True, output_format, georeference)
+	save_label_image(true_lc_image.astype(np.int32),
+		os.path.join(output_dir, 'true_labels.tif'), True, output_format,
+		georeference)
+	return
+
+
+def read_manifest(manifest_filename):
+	''' Read the ROIs listed in a CSV file (with a header row) or a JSON list.
+	    Each ROI has an input_filename, center_lat and center_lon, and
+	    optionally a region_dim and a name for its output subdirectory.
+	    Relative input filenames are relative to the manifest. '''
+	with open(manifest_filename, 'r') as f:
+		if manifest_filename.endswith('.json'):
+			rows = json.load(f)
+		else:
+			rows = list(csv.DictReader(f))
+	manifest_dir = os.path.dirname(os.path.abspath(manifest_filename))
+	rois = []
+	for i, row in enumerate(rows):
+		rois.append({
+			'input_filename': os.path.join(manifest_dir,
+										   row['input_filename']),
+			'center_lat': float(row['center_lat']),
+			'center_lon': float(row['center_lon']),
+			'region_dim': int(row.get('region_dim') or 1024),
+			'name': str(row.get('name') or 'roi{}'.format(i))})
+		assert rois[-1]['region_dim'] > 0, \
+			'Region dimension must be positive (ROI {}).'.format(i)
+	return(rois)
+
+
+worker_model = None
+worker_cache = None
+
 
-	temp = np.transpose(np.eye(5)[true_lc_image.astype(np.int32)], [2, 0, 1])
-	save_label_image(temp, os.path.join(output_dir, 'true_labels.tif'),
-		hard=True)
+def init_worker(model_filename, window_dim=None, padding=None,
+	prediction_cache_dir=None, prediction_cache_gb=10):
+	''' Load the model (and open the prediction cache) once in each process
+	    of the batch evaluation pool '''
+	global worker_model, worker_cache
+	worker_model = load_model(model_filename, window_dim, padding)
+	worker_cache = open_prediction_cache(prediction_cache_dir,
+		prediction_cache_gb, model_filename, worker_model)
+	return
+
+
+def worker_cache_counts():
+	return((0, 0) if worker_cache is None else worker_cache.counts())
+
+
+def eval_tile_rois(task):
+	''' Label all of the ROIs that lie in one tile. Only the padded window
+	    around each ROI (widened to the tile's grid of output squares, as in
+	    eval) is read from the tile. '''
+	from osgeo import gdal
+	input_filename, rois, output_dir, batch_size, output_format = task
+	plan = TilingPlan.for_model(worker_model)
+	padding = plan.padding
+	counts_before = worker_cache_counts()
+	naip_dataset = gdal.Open(input_filename, gdal.GA_ReadOnly)
+	landcover_dataset = gdal.Open(input_filename.replace('_NAIP.tif',
+		'_LandCover.tif'), gdal.GA_ReadOnly)
+	georeferencer = get_georeferencer(input_filename)
+	center_xs, center_ys = georeferencer.pixels_from_latlon(
+		[roi['center_lat'] for roi in rois], [roi['center_lon'] for roi in rois])
+
+	for roi, center_x, center_y in zip(rois, center_xs.tolist(),
+									   center_ys.tolist()):
+		region_dim = roi['region_dim']
+		x = int(center_x) - region_dim // 2
+		y = int(center_y) - region_dim // 2
+		grid_x, grid_y, grid_height, grid_width = plan.grid_region(
+			x, y, region_dim, region_dim)
+		naip_image = prepare_naip(read_dataset(naip_dataset,
+			(grid_x - padding, grid_y - padding, grid_height + 2 * padding,
+			 grid_width + 2 * padding)))
+		true_lc_image = read_landcover_window(landcover_dataset, x, y,
+											  region_dim)
+		pred_lc_image = predict_windows(worker_model, naip_image, batch_size,
+										worker_cache)
+		x_crop, y_crop = x - grid_x, y - grid_y
+		pred_lc_image = pred_lc_image[:, x_crop:x_crop + region_dim,
+									  y_crop:y_crop + region_dim]
+		naip_image = naip_image[:, x_crop:x_crop + region_dim + 2 * padding,
+								y_crop:y_crop + region_dim + 2 * padding]
+		roi_output_dir = os.path.join(output_dir, roi['name'])
+		os.makedirs(roi_output_dir, exist_ok=True)
+		save_outputs(naip_image, pred_lc_image, true_lc_image, padding,
+					 roi_output_dir, output_format,
+					 georeferencer.georeference(x, y))
+	return(input_filename, len(rois), np.subtract(worker_cache_counts(),
+												  counts_before))
+
+
+def batch_eval(manifest_filename, model_filename, output_dir, num_processes,
+	batch_size=16, output_format='rgb', window_dim=None, padding=None,
+	prediction_cache_dir=None, prediction_cache_gb=10):
+	''' Label every ROI in a manifest. ROIs are grouped by tile, and the tiles
+	    are shared out between a pool of processes that each load the model
+	    once. Each ROI's outputs are written to its own subdirectory. '''
+	tiles = {}
+	for roi in read_manifest(manifest_filename):
+		tiles.setdefault(roi['input_filename'], []).append(roi)
+	tasks = [(input_filename, rois, output_dir, batch_size, output_format)
+			 for input_filename, rois in sorted(tiles.items())]
+
+	cache_counts = np.zeros(2, dtype=np.int64)
+	with multiprocessing.Pool(num_processes, initializer=init_worker,
+							  initargs=(model_filename, window_dim, padding,
+										prediction_cache_dir,
+										prediction_cache_gb)) as pool:
+		for input_filename, num_rois, counts in pool.imap_unordered(
+			eval_tile_rois, tasks):
+			print('Labeled {} ROIs in {}'.format(num_rois, input_filename))
+			cache_counts += counts
+	if prediction_cache_dir is not None:
+		print_cache_counts(*cache_counts)
 	return
 
 
@@ -160,28 +719,123 @@ Expects an input directory containing pairs of images with naming convention
 trained model and training checkpoints to a specified model directory (will
 load a checkpoint from this directory if a checkpoint is found there).
 ''')
-	parser.add_argument('-i', '--input_filename', type=str, required=True,
+	parser.add_argument('-i', '--input_filename', type=str, required=False,
 						help='Filepath to the input NAIP image')
+	parser.add_argument('--manifest', type=str, required=False, default=None,
+						help='CSV or JSON file listing ROIs (input_filename, ' +
+						'center_lat, center_lon, and optionally region_dim ' +
+						'and name) to label in place of --input_filename')
+	parser.add_argument('--test_dir', type=str, required=False, default=None,
+						help='Directory of NAIP/LandCover pairs on which to ' +
+						'compute accuracy, IoU and log-likelihood, in place ' +
+						'of --input_filename')
+	parser.add_argument('--tile_dir', type=str, required=False, default=None,
+						help='Directory of NAIP tiles from which to label ' +
+						'the region given by --bbox (or --center_lat, ' +
+						'--center_lon and --region_dim), in place of ' +
+						'--input_filename. The region may span tiles.')
+	parser.add_argument('--bbox', type=float, nargs=4, required=False,
+						default=None,
+						metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'),
+						help='Bounding box of the region to label with ' +
+						'--tile_dir')
+	parser.add_argument('-p', '--num_processes', type=int, required=False,
+						default=multiprocessing.cpu_count(),
+						help='Number of processes used with --manifest or ' +
+						'--test_dir')
 	parser.add_argument('-m', '--model_filename', type=str, required=True,
 						help='Filepath to the trained model')
 	parser.add_argument('-o', '--output_dir', type=str, required=True,
 						help='Directory where output will be written')
-	parser.add_argument('-t', '--center_lat', type=float, required=True,
-						help='The latitude at the center of the ROI')
-	parser.add_argument('-n', '--center_lon', type=float, required=True,
+	parser.add_argument('-t', '--center_lat', type=float, required=False,
+						default=None,
+						help='The latitude at the center of the ROI (omit ' +
+						'along with --center_lon to label the whole tile)')
+	parser.add_argument('-n', '--center_lon', type=float, required=False,
+						default=None,
 						help='The longitude at the center of the ROI')
 	parser.add_argument('-r', '--region_dim', type=int, required=False,
 						default=1024,
 						help='The side length of the ROI in pixels (meters)')
+	parser.add_argument('-b', '--batch_size', type=int, required=False,
+						default=16,
+						help='Number of windows passed to the model per call')
+	parser.add_argument('-s', '--stream', action='store_true',
+						help='Label the whole tile window by window without ' +
+						'loading it into memory, writing predicted label ' +
+						'indices to pred_labels.tif in the output directory')
+	parser.add_argument('-f', '--output_format', type=str, required=False,
+						default='rgb', choices=['rgb', 'geotiff', 'paletted'],
+						help='Save uint8 RGB TIFFs, tiled and compressed ' +
+						'RGB GeoTIFFs, or single-band paletted GeoTIFFs')
+	parser.add_argument('-w', '--window_dim', type=int, required=False,
+						default=None,
+						help='Side length of the windows passed to the ' +
+						'model (by default, the size it was trained with). ' +
+						'Larger windows overlap less, so less computation ' +
+						'is repeated.')
+	parser.add_argument('--padding', type=int, required=False, default=None,
+						help='Pixels dropped from each side of a window\'s ' +
+						'prediction; at least half the model\'s receptive ' +
+						'field (by default, as in training)')
+	parser.add_argument('--prediction_cache_dir', type=str, required=False,
+						default=None,
+						help='Directory in which to keep the model\'s scores ' +
+						'for each input window (as float16), so that windows ' +
+						'seen before with the same model file and tiling are ' +
+						'not evaluated again')
+	parser.add_argument('--prediction_cache_gb', type=float, required=False,
+						default=10,
+						help='Size of the prediction cache in GB; the least ' +
+						'recently used entries are removed beyond it')
 	args = parser.parse_args()
 
-	assert os.path.exists(args.input_filename), \
-		'Input file {} could not be accessed.'.format(args.input_filename)
+	if args.manifest is not None:
+		assert os.path.exists(args.manifest), \
+			'Manifest {} could not be accessed.'.format(args.manifest)
+	elif args.test_dir is not None:
+		assert os.path.exists(args.test_dir), \
+			'Test directory {} could not be accessed.'.format(args.test_dir)
+	elif args.tile_dir is not None:
+		assert os.path.exists(args.tile_dir), \
+			'Tile directory {} could not be accessed.'.format(args.tile_dir)
+		assert args.bbox is not None or args.center_lat is not None, \
+			'Specify --bbox, or --center_lat and --center_lon.'
+	else:
+		assert args.input_filename is not None and \
+			os.path.exists(args.input_filename), \
+			'Input file {} could not be accessed.'.format(args.input_filename)
 	assert os.path.exists(args.model_filename), \
 		'Model file {} could not be accessed.'.format(args.model_filename)
-	assert args.region_dim % 128 == 0, \
-		'Region dimension must be divisible by 128.'
+	assert args.region_dim > 0, 'The region dimension must be positive.'
+	assert (args.center_lat is None) == (args.center_lon is None), \
+		'Specify both --center_lat and --center_lon, or neither.'
+	assert args.batch_size > 0, 'The batch size must be greater than zero.'
 	os.makedirs(args.output_dir, exist_ok=True)
 
-	eval(args.input_filename, args.model_filename, args.output_dir,
-		args.center_lat, args.center_lon, args.region_dim)
+	if args.test_dir is not None:
+		evaluate_directory(args.test_dir, args.model_filename, args.output_dir,
+			args.num_processes, args.batch_size, args.window_dim, args.padding,
+			args.prediction_cache_dir, args.prediction_cache_gb)
+	elif args.tile_dir is not None:
+		mosaic_eval(args.tile_dir, args.model_filename, args.output_dir,
+			args.bbox, args.center_lat, args.center_lon, args.region_dim,
+			args.batch_size, args.window_dim, args.padding,
+			args.prediction_cache_dir, args.prediction_cache_gb)
+	elif args.manifest is not None:
+		batch_eval(args.manifest, args.model_filename, args.output_dir,
+			args.num_processes, args.batch_size, args.output_format,
+			args.window_dim, args.padding, args.prediction_cache_dir,
+			args.prediction_cache_gb)
+	elif args.stream:
+		assert args.center_lat is None, \
+			'Streaming mode always labels the whole tile; omit the ROI center.'
+		stream_eval(args.input_filename, args.model_filename,
+			os.path.join(args.output_dir, 'pred_labels.tif'), args.batch_size,
+			args.window_dim, args.padding, args.prediction_cache_dir,
+			args.prediction_cache_gb)
+	else:
+		eval(args.input_filename, args.model_filename, args.output_dir,
+			args.center_lat, args.center_lon, args.region_dim, args.batch_size,
+			args.output_format, args.window_dim, args.padding,
+			args.prediction_cache_dir, args.prediction_cache_gb)
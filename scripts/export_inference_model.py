@@ -0,0 +1,283 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+import argparse, os, time, cntk
+from cntk.logging.graph import depth_first_search
+
+
+def find_functions(model, op_name):
+	''' Functions (including blocks such as layers) with the given op name '''
+	return(depth_first_search(model, lambda f: isinstance(f, cntk.Function)
+		and f.op_name == op_name))
+
+
+def named_input(function, name):
+	return([i for i in function.inputs if i.name == name][0])
+
+
+def data_input(function):
+	''' The single input of a layer that is not a parameter or constant '''
+	return([i for i in function.inputs
+			if not (i.is_parameter or i.is_constant)][0])
+
+
+def kernel_input(conv):
+	''' The kernel of a convolution layer (named 'W', unless it was replaced
+	    when folding batch normalization) '''
+	return([i for i in conv.inputs
+			if (i.is_parameter or i.is_constant) and len(i.shape) == 4][0])
+
+
+def bias_input(conv):
+	''' The bias of a convolution layer, or None if it has none '''
+	biases = [i for i in conv.inputs
+			  if (i.is_parameter or i.is_constant) and len(i.shape) != 4]
+	return(biases[0] if len(biases) > 0 else None)
+
+
+def replace_kernel(conv, kernel, operand):
+	''' Copy a convolution layer with a new kernel, applied to operand '''
+	placeholder = cntk.placeholder()
+	new_conv = conv.clone(cntk.CloneMethod.freeze,
+						  {data_input(conv): placeholder,
+						   named_input(conv, 'W'): cntk.constant(kernel)})
+	new_conv.replace_placeholders({placeholder: operand})
+	return(new_conv)
+
+
+def fold_batch_normalization(model):
+	''' Fold each BatchNormalization layer that follows a bias-free
+	    Convolution layer (as in model_mini_pub.conv_bn) into the convolution
+	    kernel and a bias. One layer is replaced per clone, because each
+	    replacement refers to the not-yet-folded graph upstream of it. '''
+	while True:
+		candidates = [bn for bn in find_functions(model, 'BatchNormalization')
+					  if data_input(bn).owner is not None and
+					  data_input(bn).owner.op_name == 'Convolution']
+		if len(candidates) == 0:
+			return(model)
+		bn = candidates[0]
+		conv = data_input(bn).owner
+
+		# CNTK keeps the running variance in 'aggregate_variance'
+		scale = named_input(bn, 'scale').value.reshape(-1)
+		bias = named_input(bn, 'bias').value.reshape(-1)
+		mean = named_input(bn, 'aggregate_mean').value.reshape(-1)
+		variance = named_input(bn, 'aggregate_variance').value.reshape(-1)
+		root = bn.block_root if bn.is_block else bn
+		epsilon = root.attributes.get('epsilon', 0.00001)
+		factor = scale / np.sqrt(variance + epsilon)
+
+		kernel = named_input(conv, 'W').value
+		folded_kernel = (kernel * factor.reshape((-1,) + (1,) *
+			(kernel.ndim - 1))).astype(np.float32)
+		folded_bias = (bias - mean * factor).astype(np.float32)
+		replacement = cntk.plus(
+			replace_kernel(conv, folded_kernel, data_input(conv)),
+			cntk.constant(folded_bias.reshape((-1, 1, 1))))
+		model = model.clone(cntk.CloneMethod.freeze,
+							{bn.output: replacement.output})
+
+
+def is_same_size_convolution(variable):
+	''' Whether a variable is the output of a Convolution layer with an odd,
+	    square kernel whose output has the spatial size of its input (that
+	    is, with a stride of one and padding) '''
+	f = variable.owner
+	if f is None or f.op_name != 'Convolution':
+		return(False)
+	kernel_shape = kernel_input(f).shape
+	return(kernel_shape[2] == kernel_shape[3] and kernel_shape[2] % 2 == 1
+		   and kernel_shape[1] == data_input(f).shape[0]
+		   and f.output.shape[1:] == data_input(f).shape[1:])
+
+
+def sum_terms(variable):
+	''' The terms of a (possibly nested) sum '''
+	if variable.owner is None or variable.owner.op_name != 'Plus':
+		return([variable])
+	return([t for i in variable.owner.inputs for t in sum_terms(i)])
+
+
+def kernel_groups(terms):
+	''' Group the same-size convolutions among the terms of a sum by kernel
+	    shape (ignoring input channels) '''
+	groups = {}
+	for t in terms:
+		if is_same_size_convolution(t):
+			shape = kernel_input(t.owner).shape
+			groups.setdefault((shape[0],) + shape[2:], []).append(t.owner)
+	return(list(groups.values()))
+
+
+def merge_parallel_convolutions(model):
+	''' Replace the convolution layers with the same kernel size in each sum
+	    of convolutions over inputs of the same spatial size (o1, o2 and o3
+	    in model_mini_pub.resu_model) with one convolution over the spliced
+	    inputs; the kernels are concatenated and the biases summed. Kernels
+	    of different sizes are not merged, since padding the smaller ones
+	    would add multiply-accumulates: o1's 3x3 convolution stays separate
+	    from its two merged 1x1s. Only the outermost Plus of a nested sum is
+	    replaced. '''
+	while True:
+		pluses = find_functions(model, 'Plus')
+		nested = set(i.owner.uid for f in pluses for i in f.inputs
+					 if i.owner is not None and i.owner.op_name == 'Plus')
+		candidates = []
+		for f in pluses:
+			if f.uid in nested:
+				continue
+			terms = sum_terms(f.output)
+			groups = kernel_groups(terms)
+			if any(len(convs) > 1 for convs in groups):
+				candidates.append((f, terms, groups))
+		if len(candidates) == 0:
+			return(model)
+		plus, terms, groups = candidates[0]
+		replacement = None
+		for convs in groups:
+			kernel = np.concatenate([kernel_input(c).value for c in convs],
+									axis=1)
+			merged = cntk.convolution(cntk.constant(kernel), cntk.splice(
+				*[data_input(c) for c in convs], axis=0),
+				auto_padding=[False, True, True])
+			biases = [bias_input(c) for c in convs
+					  if bias_input(c) is not None]
+			if len(biases) > 0:
+				merged = cntk.plus(merged, cntk.constant(
+					sum(b.value for b in biases)))
+			replacement = merged if replacement is None else \
+				cntk.plus(replacement, merged)
+		for term in terms:
+			if not is_same_size_convolution(term):
+				replacement = cntk.plus(replacement, term)
+		model = model.clone(cntk.CloneMethod.freeze,
+							{plus.output: replacement.output})
+
+
+def count_macs(model):
+	''' Multiply-accumulates per window in the model's convolution layers.
+	    Each kernel weight is applied once per output pixel of a
+	    Convolution, and once per input pixel of a ConvolutionTranspose. '''
+	macs = 0
+	for f in find_functions(model, 'Convolution'):
+		macs += kernel_input(f).value.size * int(np.prod(f.output.shape[1:]))
+	for f in find_functions(model, 'ConvolutionTranspose'):
+		macs += kernel_input(f).value.size * int(np.prod(
+			data_input(f).shape[1:]))
+	return(macs)
+
+
+def quantize(values, precision, axis=0):
+	''' Round weights to float16, or to int8 with one scale per output
+	    channel (along axis), and return them as float32 '''
+	if precision == 'float16':
+		return(values.astype(np.float16).astype(np.float32))
+	channels = np.moveaxis(values, axis, 0)
+	channel_max = np.abs(channels.reshape(channels.shape[0], -1)).max(axis=1)
+	step = np.maximum(channel_max, 1e-12).reshape((-1,) + (1,) *
+		(values.ndim - 1)) / 127.0
+	quantized = np.round(channels / step).clip(-127, 127) * step
+	return(np.moveaxis(quantized, 0, axis).astype(np.float32))
+
+
+def quantize_weights(model, precision):
+	''' Replace each convolution kernel with its quantized values. The
+	    output channels are the first axis of a Convolution kernel, and the
+	    second of a ConvolutionTranspose kernel. '''
+	substitutions = {}
+	for op_name, axis in (('Convolution', 0), ('ConvolutionTranspose', 1)):
+		for f in find_functions(model, op_name):
+			kernel = kernel_input(f)
+			if kernel.is_constant and kernel not in substitutions:
+				substitutions[kernel] = cntk.constant(
+					quantize(kernel.value, precision, axis))
+	return(model.clone(cntk.CloneMethod.freeze, substitutions))
+
+
+def compare_models(original, exported, num_samples, repeats=5):
+	''' Parity and CPU latency of the exported model against the original on
+	    random NAIP-like input '''
+	features = np.random.randint(0, 256, size=(num_samples,) +
+		original.arguments[0].shape).astype(np.float32) / 256.0
+	timings = []
+	outputs = []
+	for model in (original, exported):
+		outputs.append(np.asarray(model.eval({model.arguments[0]: features})))
+		durations = []
+		for _ in range(repeats):
+			start = time.perf_counter()
+			model.eval({model.arguments[0]: features})
+			durations.append(time.perf_counter() - start)
+		timings.append(min(durations))
+	print('Max absolute difference: {:.2e}'.format(
+		np.abs(outputs[0] - outputs[1]).max()))
+	print('Labels agreeing: {:.4f}%'.format(100 * np.mean(
+		outputs[0].argmax(axis=1) == outputs[1].argmax(axis=1))))
+	print('Latency for {} windows: original {:.3f} s, exported {:.3f} s'.format(
+		num_samples, timings[0], timings[1]))
+	return
+
+
+def export(model_filename, output_filename, precision='float32',
+	output_format='cntk', num_samples=4):
+	''' Create a lean inference graph from a trained model '''
+	original = cntk.load_model(model_filename)
+	exported = original.clone(cntk.CloneMethod.freeze)
+	exported = fold_batch_normalization(exported)
+	merged = merge_parallel_convolutions(exported)
+	macs_before, macs_after = count_macs(exported), count_macs(merged)
+	print('Multiply-accumulates per window: {:,} before merging '.format(
+		macs_before) + 'convolutions, {:,} after'.format(macs_after))
+	if macs_after > macs_before:
+		print('Merging would add computation, so it was skipped')
+	else:
+		exported = merged
+	if precision != 'float32':
+		exported = quantize_weights(exported, precision)
+
+	compare_models(original, exported, num_samples)
+	if output_format == 'onnx':
+		exported.save(output_filename, format=cntk.ModelFormat.ONNX)
+	else:
+		exported.save(output_filename)
+	print('Saved inference model to {}'.format(output_filename))
+	return
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='''
+Exports a trained model for inference. Batch normalization layers are folded
+into the preceding convolutions, convolutions with the same kernel size whose
+outputs are summed are merged into one, and parameters are frozen. Kernels can optionally be
+rounded to float16 or int8 (per output channel) precision; CNTK still
+evaluates the graph in float32, so this shows the accuracy of reduced-precision
+weights before deploying them to a runtime with float16 or int8 kernels (e.g.
+through an ONNX export). The exported model is checked against the original,
+and their CPU latencies compared.
+''')
+	parser.add_argument('-m', '--model_filename', type=str, required=True,
+						help='Filepath to the trained model')
+	parser.add_argument('-o', '--output_filename', type=str, required=True,
+						help='Filepath for the exported model')
+	parser.add_argument('-p', '--precision', type=str, required=False,
+						default='float32',
+						choices=['float32', 'float16', 'int8'],
+						help='Precision to which kernels are rounded')
+	parser.add_argument('-f', '--format', type=str, required=False,
+						default='cntk', choices=['cntk', 'onnx'],
+						help='Format of the exported model')
+	parser.add_argument('-n', '--num_samples', type=int, required=False,
+						default=4,
+						help='Number of random windows used for the checks')
+	args = parser.parse_args()
+
+	assert os.path.exists(args.model_filename), \
+		'Model file {} could not be accessed.'.format(args.model_filename)
+
+	export(args.model_filename, args.output_filename, args.precision,
+		   args.format, args.num_samples)
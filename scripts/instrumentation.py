@@ -0,0 +1,85 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import threading, time, json, contextlib
+
+
+class StageTimer(object):
+	''' Accumulates wall-clock time and counters for named pipeline stages.
+
+	    Stages may be timed from several threads at once (e.g. minibatch
+	    producers), so their times can add up to more than the elapsed time.
+	    If filename is given, report() appends a JSON line summarizing the
+	    interval since the previous report. '''
+	def __init__(self, filename=None, rank=0):
+		self.filename = filename
+		self.rank = rank
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.seconds = {}
+			self.calls = {}
+			self.counters = {}
+			self.start = time.perf_counter()
+		return
+
+	def add(self, stage, seconds):
+		with self.lock:
+			self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+			self.calls[stage] = self.calls.get(stage, 0) + 1
+		return
+
+	def count(self, counter, value=1):
+		with self.lock:
+			self.counters[counter] = self.counters.get(counter, 0) + value
+		return
+
+	@contextlib.contextmanager
+	def time(self, stage):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(stage, time.perf_counter() - start)
+
+	def summary(self):
+		with self.lock:
+			elapsed = time.perf_counter() - self.start
+			samples = self.counters.get('samples', 0)
+			return({'rank': self.rank,
+					'elapsed_seconds': elapsed,
+					'samples_per_second': samples / elapsed if elapsed else 0.0,
+					'stage_seconds': dict(self.seconds),
+					'stage_calls': dict(self.calls),
+					'counters': dict(self.counters)})
+
+	def report(self):
+		''' Write a summary of the interval since the last report, then start
+		    a new interval '''
+		summary = self.summary()
+		if self.filename is not None:
+			with open(self.filename, 'a') as f:
+				f.write(json.dumps(summary) + '\n')
+		self.reset()
+		return(summary)
+
+
+class NullTimer(object):
+	''' Stands in for StageTimer when instrumentation is disabled '''
+	def add(self, stage, seconds):
+		return
+
+	def count(self, counter, value=1):
+		return
+
+	@contextlib.contextmanager
+	def time(self, stage):
+		yield
+
+	def report(self):
+		return(None)
@@ -0,0 +1,64 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+import os, argparse, json
+from raster_io import read_image_pair
+
+
+def write_shard_pair(tile_name, output_dir):
+	''' Decode one NAIP/LandCover TIF pair and save both as uint8 .npy files
+	    in the transposed, channel-first layout used for training '''
+	naip_image, landcover_image = read_image_pair(tile_name)
+	assert naip_image.dtype == np.uint8, \
+		'Expected uint8 NAIP imagery in {}_NAIP.tif'.format(tile_name)
+	base_name = os.path.join(output_dir, os.path.basename(tile_name))
+	np.save('{}_NAIP.npy'.format(base_name), np.ascontiguousarray(naip_image))
+	np.save('{}_LandCover.npy'.format(base_name),
+			np.ascontiguousarray(landcover_image.astype(np.uint8)))
+	return(list(naip_image.shape))
+
+
+def make_shards(input_dir, output_dir):
+	''' Convert every TIF pair in input_dir and write an index of the shards '''
+	tile_names = sorted([os.path.join(input_dir, i.replace('_NAIP.tif', ''))
+						 for i in os.listdir(input_dir)
+						 if i.endswith('_NAIP.tif')])
+	tiles = []
+	for tile_name in tile_names:
+		try:
+			shape = write_shard_pair(tile_name, output_dir)
+		except ValueError:
+			print('Failed to load TIF pair: {}'.format(tile_name))
+			continue
+		tiles.append({'name': os.path.basename(tile_name), 'shape': shape})
+		print('Converted {}'.format(tile_name))
+
+	with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+		json.dump({'tiles': tiles}, f, indent=1)
+	print('Wrote {} shard pairs to {}'.format(len(tiles), output_dir))
+	return
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='''
+Converts a directory of training image pairs (with naming convention
+"[filename_base]_NAIP.tif" and "[filename_base]_LandCover.tif") into uint8
+.npy shards with an index.json file. Pass the output directory to
+train_distributed.py as its input directory to memory-map the shards instead
+of decoding the TIFFs on every worker.
+''')
+	parser.add_argument('-i', '--input_dir', type=str, required=True,
+						help='Directory containing all training image files.')
+	parser.add_argument('-o', '--output_dir', type=str, required=True,
+						help='Directory where the shards will be written.')
+	args = parser.parse_args()
+
+	assert os.path.exists(args.input_dir), \
+		'Input directory {} could not be accessed.'.format(args.input_dir)
+	os.makedirs(args.output_dir, exist_ok=True)
+
+	make_shards(args.input_dir, args.output_dir)
@@ -0,0 +1,62 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+
+
+class ConfusionAccumulator(object):
+	''' Accumulates a confusion matrix and the log-likelihood of the true
+	    labels over any number of windows, in constant memory. Pixels whose
+	    true label is ignore_label ("No data") are not counted. Partial
+	    results, e.g. from different workers, can be combined with merge(). '''
+	def __init__(self, num_classes=5, ignore_label=0):
+		self.num_classes = num_classes
+		self.ignore_label = ignore_label
+		self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+		self.log_likelihood = 0.0
+
+	def update(self, true_labels, pred_scores):
+		''' Add a window of true labels (height x width) and the model's
+		    unnormalized scores (num_classes x height x width) '''
+		true_labels = true_labels.astype(np.intp)
+		keep = true_labels != self.ignore_label
+		true_labels = true_labels[keep]
+		pred_scores = pred_scores[:, keep]
+		self.confusion += np.bincount(
+			true_labels * self.num_classes + pred_scores.argmax(axis=0),
+			minlength=self.num_classes ** 2).reshape(self.num_classes,
+													 self.num_classes)
+
+		max_scores = pred_scores.max(axis=0)
+		log_partition = max_scores + np.log(np.exp(
+			pred_scores - max_scores).sum(axis=0))
+		self.log_likelihood += float(np.sum(pred_scores[
+			true_labels, np.arange(len(true_labels))] - log_partition))
+		return
+
+	def merge(self, other):
+		self.confusion += other.confusion
+		self.log_likelihood += other.log_likelihood
+		return(self)
+
+	def summary(self):
+		''' Accuracy, per-class IoU, mean IoU (over the classes present) and
+		    mean log-likelihood of the true labels '''
+		num_pixels = self.confusion.sum()
+		true_positives = np.diag(self.confusion).astype(np.float64)
+		union = self.confusion.sum(axis=0) + self.confusion.sum(axis=1) - \
+			true_positives
+		with np.errstate(divide='ignore', invalid='ignore'):
+			iou = true_positives / union
+		present = self.confusion.sum(axis=1) > 0
+		return({'num_pixels': int(num_pixels),
+				'accuracy': float(true_positives.sum() / max(num_pixels, 1)),
+				'iou': [None if np.isnan(v) else float(v) for v in iou],
+				'mean_iou': float(np.nanmean(iou[present])) if present.any()
+							else None,
+				'mean_log_likelihood':
+					self.log_likelihood / max(num_pixels, 1),
+				'confusion_matrix': self.confusion.tolist()})
@@ -0,0 +1,105 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+import threading, queue, time
+
+
+def minibatch_rng(seed, worker_rank, batch_index):
+	''' Random state for one minibatch. Deriving it from the batch index makes
+	    the minibatch stream independent of how many threads produce it. '''
+	return(np.random.RandomState([seed, worker_rank, batch_index]))
+
+
+class MinibatchPrefetcher(object):
+	''' Builds minibatches on background threads ahead of the trainer.
+
+	    make_minibatch(batch_index, rng) is called with consecutive batch
+	    indices starting at first_index. Thread t builds the batches whose
+	    index is congruent to t modulo num_threads and places them in its own
+	    bounded queue; next() reads the queues in turn, so batches are always
+	    returned in index order. '''
+	def __init__(self, make_minibatch, seed, worker_rank, first_index=0,
+		num_threads=2, depth=4):
+		self.make_minibatch = make_minibatch
+		self.seed, self.worker_rank = seed, worker_rank
+		self.num_threads = num_threads
+		self.first_index = self.next_index = first_index
+		self.queues = [queue.Queue(maxsize=self.queue_size(num_threads, depth))
+					   for _ in range(num_threads)]
+		self.stopping = threading.Event()
+
+		# Stall counters: time the trainer spent waiting for a minibatch, and
+		# time producers spent blocked because their queue was already full
+		self.batches_consumed = 0
+		self.consumer_wait_seconds = 0.0
+		self.producer_wait_seconds = [0.0] * num_threads
+
+		self.threads = [threading.Thread(target=self._produce,
+										 args=(t, first_index + t),
+										 daemon=True)
+						for t in range(num_threads)]
+		for thread in self.threads:
+			thread.start()
+
+	@staticmethod
+	def queue_size(num_threads, depth):
+		return(max(1, depth // num_threads))
+
+	@staticmethod
+	def max_batches_in_flight(num_threads, depth):
+		''' Bound on the span of batch indices that may be in use at once: the
+		    batch held by the consumer, the queued batches and the batches
+		    being built. Buffers indexed by batch index modulo this number are
+		    never overwritten while in use. '''
+		return((MinibatchPrefetcher.queue_size(num_threads, depth) + 1) *
+			   num_threads + 1)
+
+	def _produce(self, thread_idx, batch_index):
+		while not self.stopping.is_set():
+			try:
+				item = self.make_minibatch(batch_index, minibatch_rng(
+					self.seed, self.worker_rank, batch_index))
+			except Exception as e:
+				item = e
+			start = time.perf_counter()
+			while not self.stopping.is_set():
+				try:
+					self.queues[thread_idx].put(item, timeout=0.1)
+					break
+				except queue.Full:
+					pass
+			self.producer_wait_seconds[thread_idx] += \
+				time.perf_counter() - start
+			if isinstance(item, Exception):
+				return
+			batch_index += self.num_threads
+
+	def next(self):
+		''' Return the next minibatch, blocking until it is ready '''
+		start = time.perf_counter()
+		item = self.queues[(self.next_index - self.first_index) %
+						   self.num_threads].get()
+		self.consumer_wait_seconds += time.perf_counter() - start
+		if isinstance(item, Exception):
+			raise item
+		self.next_index += 1
+		self.batches_consumed += 1
+		return(item)
+
+	def stats(self):
+		''' Summarize the stall counters '''
+		return({'batches_consumed': self.batches_consumed,
+				'consumer_wait_seconds': self.consumer_wait_seconds,
+				'producer_wait_seconds': sum(self.producer_wait_seconds),
+				'queued_batches': sum(q.qsize() for q in self.queues)})
+
+	def stop(self):
+		''' Stop the producer threads, discarding any prefetched minibatches '''
+		self.stopping.set()
+		for thread in self.threads:
+			thread.join()
+		return
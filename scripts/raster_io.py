@@ -0,0 +1,191 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+import os, threading, warnings
+from concurrent.futures import ThreadPoolExecutor
+
+# NAIP values are divided by 256 before they are passed to the model, in
+# training and evaluation alike
+naip_scale = 1.0 / 256.0
+
+
+def default_threads():
+	return(min(8, os.cpu_count() or 1))
+
+
+def raster_size(filename):
+	''' (width, height) of a TIFF image, read from its header only '''
+	import tifffile
+	with tifffile.TiffFile(filename) as tif:
+		page = tif.pages[0]
+		return(page.imagewidth, page.imagelength)
+
+
+def clip_window(window, size):
+	''' The part of a window (x, y, width, height) that lies within a raster
+	    of the given (width, height) '''
+	x, y, width, height = window
+	x_start, y_start = max(x, 0), max(y, 0)
+	x_end, y_end = min(x + width, size[0]), min(y + height, size[1])
+	return(x_start, y_start, max(x_end - x_start, 0), max(y_end - y_start, 0))
+
+
+def read_chunks(page, filehandle, window, num_threads):
+	''' Decode only the strips or tiles of a TIFF page that overlap a window
+	    (x, y, width, height), on num_threads threads, into a rows x columns
+	    x bands array '''
+	x, y, width, height = window
+	image_width, image_height = page.imagewidth, page.imagelength
+	if x < 0 or y < 0 or width <= 0 or height <= 0 or \
+		x + width > image_width or y + height > image_height:
+		raise ValueError('Window {} does not lie within the {}x{} '
+						 'image.'.format(window, image_width, image_height))
+	if page.is_tiled:
+		chunk_rows, chunk_cols = page.tilelength, page.tilewidth
+	else:
+		chunk_rows = min(page.rowsperstrip, image_height)
+		chunk_cols = image_width
+	rows_down = -(-image_height // chunk_rows)
+	cols_across = -(-image_width // chunk_cols)
+	num_bands = page.samplesperpixel
+	num_planes = num_bands if page.planarconfig == 2 else 1
+	image = np.empty((height, width, num_bands), dtype=page.dtype)
+	lock = threading.Lock()
+
+	def decode(index):
+		plane, position = divmod(index, rows_down * cols_across)
+		row, col = divmod(position, cols_across)
+		row, col = row * chunk_rows, col * chunk_cols
+		row_start, row_end = max(row, y), min(row + chunk_rows, y + height)
+		col_start, col_end = max(col, x), min(col + chunk_cols, x + width)
+		bands = slice(plane, plane + 1) if num_planes > 1 else slice(None)
+		target = image[row_start - y:row_end - y, col_start - x:col_end - x,
+					   bands]
+		if page.databytecounts[index] == 0:
+			target[...] = 0
+			return
+		# The file is shared, but decompression runs in parallel
+		with lock:
+			filehandle.seek(page.dataoffsets[index])
+			data = filehandle.read(page.databytecounts[index])
+		segment = page.decode(data, index)[0]
+		segment = segment.reshape(segment.shape[-3:])
+		target[...] = segment[row_start - row:row_end - row,
+							  col_start - col:col_end - col]
+		return
+
+	indices = [(plane * rows_down + row) * cols_across + col
+			   for plane in range(num_planes)
+			   for row in range(y // chunk_rows,
+								(y + height - 1) // chunk_rows + 1)
+			   for col in range(x // chunk_cols,
+								(x + width - 1) // chunk_cols + 1)]
+	with ThreadPoolExecutor(num_threads) as pool:
+		list(pool.map(decode, indices))
+	return(image if num_bands > 1 else image[:, :, 0])
+
+
+def read_tiff(filename, window=None, num_threads=None):
+	''' Decode a TIFF image, in the file's rows x columns (x bands) layout,
+	    with its strips or tiles decompressed in parallel. If a window
+	    (x, y, width, height) is given, only the strips or tiles it overlaps
+	    are read. '''
+	# With the currently-available training data, the tifffile package
+	# generates these RuntimeWarnings and UserWarnings under normal
+	# operating conditions:
+	# - RuntimeWarning: py_decodelzw encountered unexpected end of stream
+	# - UserWarning: unpack: string size must be a multiple of element size
+	# - UserWarning: invalid tile data
+	import tifffile
+	if num_threads is None:
+		num_threads = default_threads()
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore')
+		with tifffile.TiffFile(filename) as tif:
+			page = tif.pages[0]
+			if window is not None and hasattr(page, 'decode'):
+				return(read_chunks(page, tif.filehandle, window, num_threads))
+			image = page.asarray(maxworkers=num_threads)
+	if page.planarconfig == 2 and page.samplesperpixel > 1:
+		# Bands stored in separate planes are decoded as the first axis
+		image = np.moveaxis(image, 0, -1)
+	if window is not None:
+		# Older versions of tifffile cannot decode single strips
+		x, y, width, height = window
+		image = image[y:y + height, x:x + width]
+	return(image)
+
+
+def read_dataset(dataset, window):
+	''' Read a window (x, y, width, height) of a GDAL dataset, or of anything
+	    with the same RasterXSize, RasterYSize and ReadAsArray, in the file's
+	    rows x columns (x bands) layout. Parts of the window that fall outside
+	    the raster are reflect-padded. '''
+	x, y, width, height = window
+	x_start, y_start, clipped_width, clipped_height = clip_window(window,
+		(dataset.RasterXSize, dataset.RasterYSize))
+	image = dataset.ReadAsArray(x_start, y_start, clipped_width,
+								clipped_height)
+	if image.ndim == 3:
+		image = np.moveaxis(image, 0, -1)
+	if (x_start, y_start, clipped_width, clipped_height) != tuple(window):
+		padding = ((y_start - y, y + height - y_start - clipped_height),
+				   (x_start - x, x + width - x_start - clipped_width))
+		image = np.pad(image, padding + ((0, 0),) * (image.ndim - 2),
+					   mode='reflect')
+	return(image)
+
+
+def channels_first(image):
+	''' View a rows x columns (x bands) image in the (bands x) columns x rows
+	    layout used by the model, without copying it '''
+	return(np.transpose(image))
+
+
+def normalize_naip(image, dtype=np.float32):
+	''' Scale uint8 NAIP imagery for the model. The result keeps the memory
+	    order of image, so a transposed view is converted in one pass. '''
+	normalized = np.empty_like(image, dtype=dtype)
+	np.multiply(image, naip_scale, out=normalized)
+	return(normalized)
+
+
+def prepare_naip(image, dtype=np.float32):
+	''' Convert decoded NAIP imagery (rows x columns x bands) to the model's
+	    layout, left as uint8 if dtype is np.uint8 and normalized otherwise '''
+	image = channels_first(image)
+	if dtype == np.uint8:
+		return(image)
+	return(normalize_naip(image, dtype))
+
+
+def prepare_landcover(image):
+	''' Convert decoded LandCover labels (rows x columns) to the model's
+	    layout, grouping the labels above 4 with the barren/impervious class.
+	    The labels are modified in place. '''
+	image[image > 4] = 4
+	return(channels_first(image))
+
+
+def read_naip(filename, window=None, dtype=np.float32, num_threads=None):
+	''' Read NAIP imagery (bands x columns x rows), as in prepare_naip '''
+	return(prepare_naip(read_tiff(filename, window, num_threads), dtype))
+
+
+def read_landcover(filename, window=None, num_threads=None):
+	''' Read LandCover labels (columns x rows), as in prepare_landcover '''
+	return(prepare_landcover(read_tiff(filename, window, num_threads)))
+
+
+def read_image_pair(tile_name, window=None, dtype=np.uint8, num_threads=None):
+	''' Read the corresponding NAIP and LandCover images (or the same window
+	    of each), with the NAIP image as in read_naip '''
+	naip_image = read_naip('{}_NAIP.tif'.format(tile_name), window, dtype,
+						   num_threads)
+	landcover_image = read_landcover('{}_LandCover.tif'.format(tile_name),
+									 window, num_threads)
+	return(naip_image, landcover_image)
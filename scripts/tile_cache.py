@@ -0,0 +1,137 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+import os, time, hashlib, contextlib
+try:
+	import fcntl
+except ImportError:
+	# Windows has no flock; msvcrt locks a byte range instead
+	fcntl = None
+	import msvcrt
+
+
+@contextlib.contextmanager
+def file_lock(filename):
+	''' Hold an exclusive lock on filename, shared by all local processes '''
+	with open(filename, 'a+') as f:
+		if fcntl is not None:
+			fcntl.flock(f, fcntl.LOCK_EX)
+		else:
+			# The first byte serves as the lock, whatever the file's length
+			f.seek(0)
+			while True:
+				try:
+					msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+					break
+				except OSError:
+					time.sleep(0.01)
+		try:
+			yield
+		finally:
+			if fcntl is not None:
+				fcntl.flock(f, fcntl.LOCK_UN)
+			else:
+				f.seek(0)
+				msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class SharedTileCache(object):
+	''' A node-local cache of decoded NAIP/LandCover tile pairs.
+
+	    Tiles are decoded once per machine and stored as uint8 .npy files in
+	    cache_dir (by default on /dev/shm, so they live in shared memory). Every
+	    local worker memory-maps the same files, so all of them read the same
+	    physical pages. When adding a tile would exceed memory_budget bytes,
+	    the least recently used tiles are removed; workers that still have an
+	    evicted tile mapped keep reading it until they release it. '''
+	def __init__(self, load_fn, cache_dir='/dev/shm/landcover_tiles',
+		memory_budget=16 * 2**30):
+		''' load_fn(tile_name) decodes a tile pair, returning uint8 NAIP
+		    imagery and labels '''
+		self.load_fn = load_fn
+		self.cache_dir = cache_dir
+		self.memory_budget = memory_budget
+		os.makedirs(cache_dir, exist_ok=True)
+		self.lock_filename = os.path.join(cache_dir, 'cache.lock')
+
+	def key(self, tile_name):
+		digest = hashlib.md5(os.path.abspath(tile_name).encode()).hexdigest()
+		return('{}_{}'.format(os.path.basename(tile_name), digest[:8]))
+
+	def filenames(self, tile_name):
+		base_name = os.path.join(self.cache_dir, self.key(tile_name))
+		return('{}_NAIP.npy'.format(base_name),
+			   '{}_LandCover.npy'.format(base_name))
+
+	def load(self, tile_name):
+		''' Memory-map a tile pair, decoding it first if no local worker has
+		    done so already '''
+		naip_filename, landcover_filename = self.filenames(tile_name)
+		with file_lock(naip_filename + '.lock'):
+			with file_lock(self.lock_filename):
+				cached = os.path.exists(naip_filename)
+				if cached:
+					# Mark the tile as recently used
+					os.utime(naip_filename)
+					result = self.open(naip_filename, landcover_filename)
+			if not cached:
+				# The NAIP file is written last, marking the pair complete
+				# even if the process is interrupted in between
+				naip_image, landcover_image = self.load_fn(tile_name)
+				self.store(landcover_filename,
+						   np.ascontiguousarray(landcover_image))
+				self.store(naip_filename, np.ascontiguousarray(naip_image))
+				with file_lock(self.lock_filename):
+					self.evict(exclude=naip_filename)
+					result = self.open(naip_filename, landcover_filename)
+		return(result)
+
+	def open(self, naip_filename, landcover_filename):
+		return(np.load(naip_filename, mmap_mode='r'),
+			   np.load(landcover_filename, mmap_mode='r'))
+
+	def store(self, filename, array):
+		''' Write atomically so other workers never see a partial file '''
+		temp_filename = filename + '.tmp{}'.format(os.getpid())
+		with open(temp_filename, 'wb') as f:
+			np.save(f, array)
+		os.replace(temp_filename, filename)
+		return
+
+	def cached_tiles(self):
+		''' (last use time, size in bytes, NAIP filename) of each cached tile '''
+		tiles = []
+		for name in os.listdir(self.cache_dir):
+			if not name.endswith('_NAIP.npy'):
+				continue
+			naip_filename = os.path.join(self.cache_dir, name)
+			landcover_filename = naip_filename.replace('_NAIP.npy',
+													   '_LandCover.npy')
+			try:
+				tiles.append((os.path.getmtime(naip_filename),
+							  os.path.getsize(naip_filename) +
+							  os.path.getsize(landcover_filename),
+							  naip_filename))
+			except OSError:
+				pass
+		return(sorted(tiles))
+
+	def evict(self, exclude):
+		''' Remove least recently used tiles until the cache fits the budget.
+		    Must be called with the cache lock held. '''
+		tiles = self.cached_tiles()
+		total_size = sum(size for _, size, _ in tiles)
+		for _, size, naip_filename in tiles:
+			if total_size <= self.memory_budget:
+				break
+			if naip_filename == exclude:
+				continue
+			with contextlib.suppress(OSError):
+				os.remove(naip_filename)
+				os.remove(naip_filename.replace('_NAIP.npy', '_LandCover.npy'))
+			total_size -= size
+		return
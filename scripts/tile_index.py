@@ -0,0 +1,240 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+import os, json
+from collections import OrderedDict
+
+
+def latlon_transform(projection, to_latlon=False):
+	''' Coordinate transformation between EPSG:4326 (as lon, lat) and a
+	    projection given as WKT '''
+	from osgeo import osr
+	proj = osr.SpatialReference()
+	proj.ImportFromWkt(projection)
+	world_proj = osr.SpatialReference()
+	world_proj.ImportFromEPSG(4326)
+	for p in (proj, world_proj):
+		if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+			# GDAL 3 otherwise expects (lat, lon) order for EPSG:4326
+			p.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+	if to_latlon:
+		return(osr.CoordinateTransformation(proj, world_proj))
+	return(osr.CoordinateTransformation(world_proj, proj))
+
+
+def same_projection(projection, other):
+	from osgeo import osr
+	proj, other_proj = osr.SpatialReference(), osr.SpatialReference()
+	proj.ImportFromWkt(projection)
+	other_proj.ImportFromWkt(other)
+	return(bool(proj.IsSame(other_proj)))
+
+
+class TileIndex(object):
+	''' Footprints of the NAIP tiles in a directory, for finding the tiles
+	    that cover a point or a lat/lon bounding box.
+
+	    Each tile's projection, geotransform, size, and bounding box in
+	    latitude and longitude are read from its header when the index is
+	    built. The index is saved as JSON in the directory and reused until
+	    the set of tiles (or their modification times) changes. Queries
+	    test every footprint at once with numpy, which is fast enough for
+	    tens of thousands of tiles. '''
+	def __init__(self, tiles):
+		self.tiles = tiles
+		self.bounds = np.asarray([tile['bounds'] for tile in tiles],
+								 dtype=np.float64).reshape(-1, 4)
+
+	@staticmethod
+	def tile_files(input_dir):
+		return(dict((name, os.path.getmtime(os.path.join(input_dir, name)))
+					for name in sorted(os.listdir(input_dir))
+					if name.endswith('_NAIP.tif')))
+
+	@staticmethod
+	def read_footprint(filename):
+		''' Header information and lat/lon bounding box of one tile '''
+		from osgeo import gdal
+		dataset = gdal.Open(filename, gdal.GA_ReadOnly)
+		width, height = dataset.RasterXSize, dataset.RasterYSize
+		geotransform = dataset.GetGeoTransform()
+		projection = dataset.GetProjection()
+		ulcrnrx, xstep, xrot, ulcrnry, yrot, ystep = geotransform
+		corners = [(ulcrnrx + x * xstep + y * xrot,
+					ulcrnry + x * yrot + y * ystep)
+				   for x in (0, width) for y in (0, height)]
+		lonlats = np.asarray(latlon_transform(projection, True).TransformPoints(
+			corners))
+		return({'geotransform': list(geotransform),
+				'projection': projection,
+				'width': width,
+				'height': height,
+				'bounds': [float(lonlats[:, 1].min()),
+						   float(lonlats[:, 0].min()),
+						   float(lonlats[:, 1].max()),
+						   float(lonlats[:, 0].max())]})
+
+	@classmethod
+	def build(cls, input_dir):
+		tiles = []
+		for name, mtime in cls.tile_files(input_dir).items():
+			tile = cls.read_footprint(os.path.join(input_dir, name))
+			tile.update({'name': name, 'mtime': mtime})
+			tiles.append(tile)
+		return(cls(tiles))
+
+	@classmethod
+	def for_directory(cls, input_dir, index_filename=None):
+		''' Load the directory's saved index, rebuilding and saving it if it
+		    is missing or out of date '''
+		if index_filename is None:
+			index_filename = os.path.join(input_dir, 'tile_index.json')
+		tile_files = cls.tile_files(input_dir)
+		if os.path.exists(index_filename):
+			with open(index_filename, 'r') as f:
+				tiles = json.load(f)['tiles']
+			if dict((tile['name'], tile['mtime']) for tile in tiles) == \
+				tile_files:
+				return(cls.with_filenames(tiles, input_dir))
+
+		index = cls.build(input_dir)
+		try:
+			with open(index_filename + '.tmp{}'.format(os.getpid()), 'w') as f:
+				json.dump({'tiles': index.tiles}, f)
+			os.replace(index_filename + '.tmp{}'.format(os.getpid()),
+					   index_filename)
+		except OSError:
+			print('Could not save the tile index to {}'.format(index_filename))
+		return(cls.with_filenames(index.tiles, input_dir))
+
+	@classmethod
+	def with_filenames(cls, tiles, input_dir):
+		return(cls([dict(tile, filename=os.path.join(input_dir, tile['name']))
+					for tile in tiles]))
+
+	def query(self, min_lat, min_lon, max_lat, max_lon):
+		''' The tiles whose footprints intersect a bounding box '''
+		hits = (self.bounds[:, 0] <= max_lat) & (self.bounds[:, 2] >= min_lat) \
+			& (self.bounds[:, 1] <= max_lon) & (self.bounds[:, 3] >= min_lon)
+		return([self.tiles[i] for i in np.flatnonzero(hits)])
+
+
+class Mosaic(object):
+	''' Reads windows from a set of tiles as if they were one raster, in the
+	    manner of a GDAL dataset (RasterXSize, RasterYSize, RasterCount,
+	    ReadAsArray, GetGeoTransform, GetProjection), so that it can be used
+	    wherever a dataset is read window by window.
+
+	    The mosaic uses the pixel grid of the reference tile; other tiles in
+	    the same projection and at the same resolution are placed on that
+	    grid, and tiles in other projections are left out. A read opens only
+	    the tiles it overlaps (keeping the most recently used few open).
+	    Where tiles overlap, the one listed last wins; pixels covered by no
+	    tile are zero. '''
+	def __init__(self, tiles, reference, suffix=None, max_open=16):
+		''' If suffix is given (e.g. '_LandCover.tif'), it replaces
+		    '_NAIP.tif' in the tile filenames, to read the paired rasters '''
+		ulcrnrx, xstep, xrot, ulcrnry, yrot, ystep = reference['geotransform']
+		self.tiles = []
+		self.skipped = []
+		for tile in tiles:
+			gt = tile['geotransform']
+			if not same_projection(tile['projection'],
+								   reference['projection']) or \
+				not np.allclose(gt[1:3] + gt[4:6], [xstep, xrot, yrot, ystep]):
+				self.skipped.append(tile)
+				continue
+			self.tiles.append((tile['filename'] if suffix is None else
+							   tile['filename'].replace('_NAIP.tif', suffix),
+							   int(round((gt[0] - ulcrnrx) / xstep)),
+							   int(round((gt[3] - ulcrnry) / ystep)),
+							   tile['width'], tile['height']))
+		rects = np.asarray([t[1:] for t in self.tiles]).reshape(-1, 4)
+		self.x_offset = int(rects[:, 0].min())
+		self.y_offset = int(rects[:, 1].min())
+		self.rects = rects - [self.x_offset, self.y_offset, 0, 0]
+		self.RasterXSize = int((self.rects[:, 0] + self.rects[:, 2]).max())
+		self.RasterYSize = int((self.rects[:, 1] + self.rects[:, 3]).max())
+		self.projection = reference['projection']
+		self.geotransform = (ulcrnrx + self.x_offset * xstep +
+							 self.y_offset * xrot, xstep, xrot,
+							 ulcrnry + self.x_offset * yrot +
+							 self.y_offset * ystep, yrot, ystep)
+		self.max_open = max_open
+		self.datasets = OrderedDict()
+		first = self.open(self.tiles[0][0])
+		self.RasterCount = first.RasterCount
+		self.dtype = first.GetRasterBand(1).ReadAsArray(0, 0, 1, 1).dtype
+
+	def GetGeoTransform(self):
+		return(self.geotransform)
+
+	def GetProjection(self):
+		return(self.projection)
+
+	def open(self, filename):
+		from osgeo import gdal
+		if filename not in self.datasets:
+			self.datasets[filename] = gdal.Open(filename, gdal.GA_ReadOnly)
+			if len(self.datasets) > self.max_open:
+				self.datasets.popitem(last=False)
+		self.datasets.move_to_end(filename)
+		return(self.datasets[filename])
+
+	def ReadAsArray(self, xoff, yoff, xsize, ysize):
+		''' Read a window (bands x rows x columns, or rows x columns for a
+		    single band) from whichever tiles it overlaps '''
+		window = np.zeros((self.RasterCount, ysize, xsize), dtype=self.dtype)
+		x_start = np.maximum(self.rects[:, 0], xoff)
+		y_start = np.maximum(self.rects[:, 1], yoff)
+		x_end = np.minimum(self.rects[:, 0] + self.rects[:, 2], xoff + xsize)
+		y_end = np.minimum(self.rects[:, 1] + self.rects[:, 3], yoff + ysize)
+		for i in np.flatnonzero((x_start < x_end) & (y_start < y_end)):
+			tile_x, tile_y = self.rects[i, :2]
+			part = self.open(self.tiles[i][0]).ReadAsArray(
+				int(x_start[i] - tile_x), int(y_start[i] - tile_y),
+				int(x_end[i] - x_start[i]), int(y_end[i] - y_start[i]))
+			window[:, y_start[i] - yoff:y_end[i] - yoff,
+				   x_start[i] - xoff:x_end[i] - xoff] = part.reshape(
+				   (self.RasterCount,) + part.shape[-2:])
+		return(window[0] if self.RasterCount == 1 else window)
+
+	def covered(self, x, y):
+		''' Whether each of the pixels (x, y) lies within a tile '''
+		x, y = np.asarray(x), np.asarray(y)
+		mask = np.zeros(x.shape, dtype=bool)
+		if x.size == 0:
+			return(mask)
+		overlapping = (self.rects[:, 0] <= x.max()) & \
+			(self.rects[:, 0] + self.rects[:, 2] > x.min()) & \
+			(self.rects[:, 1] <= y.max()) & \
+			(self.rects[:, 1] + self.rects[:, 3] > y.min())
+		for tile_x, tile_y, width, height in self.rects[overlapping]:
+			mask |= (x >= tile_x) & (x < tile_x + width) & \
+				(y >= tile_y) & (y < tile_y + height)
+		return(mask)
+
+	def pixels_from_latlon(self, lats, lons):
+		''' Find the (x, y) pixel indices in the mosaic for arrays of
+		    points, as fractional values '''
+		lats, lons = np.atleast_1d(lats, lons)
+		points = np.asarray(latlon_transform(self.projection).TransformPoints(
+			np.stack([lons, lats], axis=1).astype(np.float64).tolist()))
+		ulcrnrx, xstep, _, ulcrnry, _, ystep = self.geotransform
+		return((points[:, 0] - ulcrnrx) / xstep,
+			   (points[:, 1] - ulcrnry) / ystep)
+
+	def region_from_bbox(self, min_lat, min_lon, max_lat, max_lon):
+		''' The pixel region (x, y, width, height) of the mosaic covering a
+		    lat/lon bounding box '''
+		x, y = self.pixels_from_latlon([min_lat, min_lat, max_lat, max_lat],
+									   [min_lon, max_lon, min_lon, max_lon])
+		x_start = max(int(np.floor(x.min())), 0)
+		y_start = max(int(np.floor(y.min())), 0)
+		x_end = min(int(np.ceil(x.max())), self.RasterXSize)
+		y_end = min(int(np.ceil(y.max())), self.RasterYSize)
+		return(x_start, y_start, x_end - x_start, y_end - y_start)
@@ -0,0 +1,132 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+import threading
+from collections import OrderedDict
+
+
+def assign_tiles(tile_names, tile_sizes, number_of_workers):
+	''' Split tiles between workers so that each has a similar number of
+	    pixels to sample from. Tiles are taken largest first and given to the
+	    worker with the fewest pixels so far. If there are fewer tiles than
+	    workers, tiles are dealt out in turn and some workers share tiles. '''
+	if number_of_workers >= len(tile_names):
+		return(dict((i, [tile_names[i % len(tile_names)]])
+					for i in range(number_of_workers)))
+	assignments = dict((i, []) for i in range(number_of_workers))
+	totals = np.zeros(number_of_workers)
+	for tile_idx in np.argsort(tile_sizes, kind='stable')[::-1]:
+		worker = int(np.argmin(totals))
+		assignments[worker].append(tile_names[tile_idx])
+		totals[worker] += tile_sizes[tile_idx]
+	for worker in assignments:
+		assignments[worker].sort()
+	return(assignments)
+
+
+class TileScheduler(object):
+	''' Holds one worker's tiles in memory within a budget.
+
+	    The worker's tiles are used in turn: get(position) returns the tile at
+	    that position (modulo the number of tiles), loading it if necessary,
+	    and starts loading the next tile on a background thread so that it is
+	    ready when the worker moves on. When the resident tiles exceed
+	    memory_budget bytes, the least recently used ones other than the
+	    current and next tiles are dropped (arrays still referenced by a
+	    minibatch under construction stay valid). '''
+	def __init__(self, tile_names, load_fn, memory_budget=None,
+		worker_rank=0):
+		''' load_fn(tile_name) returns a tuple of arrays for the tile, and
+		    raises ValueError if the tile cannot be loaded '''
+		self.tile_names = list(tile_names)
+		self.load_fn = load_fn
+		self.memory_budget = memory_budget
+		self.worker_rank = worker_rank
+		self.resident = OrderedDict()
+		self.failed = set()
+		self.loading = {}
+		self.current = None
+		self.lock = threading.Lock()
+
+	def get(self, position):
+		''' Return the arrays for the tile at this position. Tiles that fail
+		    to load are skipped in favor of the next one. '''
+		for offset in range(len(self.tile_names)):
+			tile_idx = (position + offset) % len(self.tile_names)
+			arrays = self._load(tile_idx)
+			if arrays is not None:
+				self.current = tile_idx
+				self._start_loading((tile_idx + 1) % len(self.tile_names))
+				return(arrays)
+		raise RuntimeError('Worker {} could not load any of its tiles'.format(
+			self.worker_rank))
+
+	def _load(self, tile_idx):
+		''' Wait for a tile to be resident, loading it on this thread unless
+		    another thread is already doing so '''
+		with self.lock:
+			if tile_idx in self.failed:
+				return(None)
+			if tile_idx in self.resident:
+				self.resident.move_to_end(tile_idx)
+				return(self.resident[tile_idx])
+			event = self.loading.get(tile_idx)
+			if event is None:
+				event = self.loading[tile_idx] = threading.Event()
+				owner = True
+			else:
+				owner = False
+		if owner:
+			return(self._load_tile(tile_idx, event))
+		event.wait()
+		with self.lock:
+			return(self.resident.get(tile_idx))
+
+	def _start_loading(self, tile_idx):
+		''' Load a tile in the background if it isn't resident or loading '''
+		with self.lock:
+			if tile_idx in self.resident or tile_idx in self.loading or \
+				tile_idx in self.failed:
+				return
+			event = self.loading[tile_idx] = threading.Event()
+		threading.Thread(target=self._load_tile, args=(tile_idx, event),
+						 daemon=True).start()
+		return
+
+	def _load_tile(self, tile_idx, event):
+		tile_name = self.tile_names[tile_idx]
+		try:
+			arrays = self.load_fn(tile_name)
+			print('Worker {} loaded {}'.format(self.worker_rank, tile_name))
+		except ValueError:
+			print('Failed to load TIF pair: {}'.format(tile_name))
+			arrays = None
+		with self.lock:
+			if arrays is None:
+				self.failed.add(tile_idx)
+			else:
+				self.resident[tile_idx] = arrays
+				self._evict(keep=tile_idx)
+			del self.loading[tile_idx]
+		event.set()
+		return(arrays)
+
+	def _evict(self, keep):
+		''' Drop least recently used tiles until within the memory budget.
+		    Must be called with the lock held. '''
+		if self.memory_budget is None:
+			return
+		resident_bytes = sum(sum(a.nbytes for a in arrays)
+							 for arrays in self.resident.values())
+		for tile_idx in list(self.resident.keys()):
+			if resident_bytes <= self.memory_budget:
+				break
+			if tile_idx in (keep, self.current):
+				continue
+			resident_bytes -= sum(a.nbytes for a in self.resident[tile_idx])
+			del self.resident[tile_idx]
+		return
@@ -0,0 +1,337 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+import os, argparse, json, time, struct, zlib, hashlib, threading
+import http.server, urllib.request
+import evaluate
+from concurrent.futures import Future
+from tiling import TilingPlan
+from tile_index import TileIndex, Mosaic
+from array_cache import MemoryArrayCache, DiskArrayCache, file_digest
+
+tile_dim = 256
+
+
+def tile_pixel_latlons(z, x, y):
+	''' Latitude and longitude of the center of each pixel (rows x columns)
+	    in an XYZ (Web Mercator) tile '''
+	steps = (np.arange(tile_dim) + 0.5) / tile_dim
+	lons = (x + steps) / 2**z * 360.0 - 180.0
+	lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + steps) / 2**z))))
+	return(np.meshgrid(lats, lons, indexing='ij'))
+
+
+def tile_from_latlon(lat, lon, z):
+	''' The (x, y) indices of the XYZ tile containing a point '''
+	lat = np.radians(lat)
+	x = int((lon + 180.0) / 360.0 * 2**z)
+	y = int((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * 2**z)
+	return(x, y)
+
+
+def encode_png(image):
+	''' Encode a uint8 image (rows x columns, with an optional trailing axis
+	    of 3 or 4 bands) as a PNG file '''
+	height, width = image.shape[:2]
+	num_bands = 1 if image.ndim == 2 else image.shape[2]
+	color_type = {1: 0, 3: 2, 4: 6}[num_bands]
+	raw = b''.join(b'\x00' + row.tobytes()
+				   for row in np.ascontiguousarray(image).reshape(height, -1))
+
+	def chunk(tag, data):
+		return(struct.pack('>I', len(data)) + tag + data +
+			   struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+	return(b'\x89PNG\r\n\x1a\n' +
+		   chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8,
+									  color_type, 0, 0, 0)) +
+		   chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+
+def downsample_labels(labels):
+	''' Halve a label image by taking the most common label in each 2x2
+	    block. Labels win ties against "No data" (0). '''
+	num_classes = len(evaluate.color_map)
+	counts = np.zeros((num_classes,) + (labels.shape[0] // 2,
+										 labels.shape[1] // 2))
+	for i in (0, 1):
+		for j in (0, 1):
+			block = labels[i::2, j::2]
+			for label_idx in range(num_classes):
+				counts[label_idx] += block == label_idx
+	counts[0] -= 0.5
+	return(counts.argmax(axis=0).astype(np.uint8))
+
+
+class PredictionTiles(object):
+	''' Predicted labels for XYZ tiles over a directory of NAIP tiles.
+
+	    Tiles at the native zoom level are computed on first request: the
+	    NAIP pixels under the tile are read (with the padding the model
+	    needs) from a Mosaic of the directory's tiles, labeled, and sampled
+	    onto the Web Mercator grid. Tiles at lower zoom levels, down to
+	    min_zoom, are overviews built from their four children. Every tile's
+	    labels are kept in a memory cache and an on-disk cache, both
+	    bounded in size; the disk cache is specific to the model (by the
+	    hash of its contents, as in PredictionCache) and window settings, so
+	    it can be reused by later runs with the same model. Concurrent
+	    requests for a tile that is being labeled wait for its labels
+	    rather than labeling it again. '''
+	def __init__(self, tile_dir, model_filename, cache_dir, memory_bytes,
+		disk_bytes, zoom=17, min_zoom=13, batch_size=16, window_dim=None,
+		padding=None):
+		self.index = TileIndex.for_directory(tile_dir)
+		self.model = evaluate.load_model(model_filename, window_dim, padding)
+		self.zoom, self.min_zoom = zoom, min_zoom
+		self.batch_size = batch_size
+		self.mosaics = {}
+		plan = TilingPlan.for_model(self.model)
+		model_key = hashlib.md5(json.dumps([file_digest(model_filename),
+			plan.window_dim, plan.padding, zoom]).encode()).hexdigest()[:12]
+		self.memory_cache = MemoryArrayCache(memory_bytes)
+		self.disk_cache = DiskArrayCache(os.path.join(cache_dir, model_key),
+										 disk_bytes)
+		# CNTK models are evaluated one request at a time
+		self.model_lock = threading.Lock()
+		# Futures for the tiles being labeled, and the mosaics opened so far,
+		# are shared by the request threads
+		self.pending = {}
+		self.lock = threading.Lock()
+
+	def get(self, z, x, y):
+		''' Label indices (rows x columns) for a tile '''
+		key = '{}_{}_{}'.format(z, x, y)
+		labels = self.memory_cache.get(key)
+		if labels is not None:
+			return(labels)
+		with self.lock:
+			future = self.pending.get(key)
+			waiting = future is not None
+			if not waiting:
+				future = self.pending[key] = Future()
+		if waiting:
+			return(future.result())
+
+		try:
+			labels = self.disk_cache.get(key)
+			if labels is None:
+				if z >= self.zoom:
+					labels = self.compute(z, x, y)
+				else:
+					labels = downsample_labels(np.concatenate([
+						np.concatenate([self.get(z + 1, 2 * x + i, 2 * y + j)
+										for i in (0, 1)], axis=1)
+						for j in (0, 1)], axis=0))
+				self.disk_cache.put(key, labels)
+			self.memory_cache.put(key, labels)
+			future.set_result(labels)
+		except Exception as e:
+			future.set_exception(e)
+			raise
+		finally:
+			with self.lock:
+				del self.pending[key]
+		return(labels)
+
+	def mosaic(self, reference):
+		with self.lock:
+			if reference['name'] not in self.mosaics:
+				self.mosaics[reference['name']] = Mosaic(self.index.tiles,
+														 reference)
+			return(self.mosaics[reference['name']])
+
+	def compute(self, z, x, y):
+		''' Label a tile from the NAIP imagery beneath it '''
+		labels = np.zeros((tile_dim, tile_dim), dtype=np.uint8)
+		lats, lons = tile_pixel_latlons(z, x, y)
+		center = (lats.mean(), lons.mean())
+		tiles = self.index.query(*center, *center) or \
+			self.index.query(lats.min(), lons.min(), lats.max(), lons.max())
+		if len(tiles) == 0:
+			return(labels)
+		mosaic = self.mosaic(tiles[0])
+		pixel_x, pixel_y = mosaic.pixels_from_latlon(lats.ravel(),
+													 lons.ravel())
+		pixel_x = np.floor(pixel_x).astype(int)
+		pixel_y = np.floor(pixel_y).astype(int)
+		covered = mosaic.covered(pixel_x, pixel_y)
+		if not covered.any():
+			return(labels)
+		pixel_x, pixel_y = pixel_x[covered], pixel_y[covered]
+
+		# Label the region of the mosaic under the tile
+		region_x, region_y = int(pixel_x.min()), int(pixel_y.min())
+		width = int(pixel_x.max()) + 1 - region_x
+		height = int(pixel_y.max()) + 1 - region_y
+		pred_labels = np.zeros((width, height), dtype=np.uint8)
+		with self.model_lock:
+			for sq_x, sq_y, sq_pred_lc in evaluate.stream_window_predictions(
+				self.model, mosaic, self.batch_size,
+				(region_x, region_y, width, height)):
+				sq_width, sq_height = sq_pred_lc.shape[1:]
+				pred_labels[sq_x:sq_x + sq_width, sq_y:sq_y + sq_height] = \
+					sq_pred_lc.argmax(axis=0)
+		labels.ravel()[covered] = pred_labels[pixel_x - region_x,
+											  pixel_y - region_y]
+		return(labels)
+
+	def stats(self):
+		return({'memory_cache': self.memory_cache.stats(),
+				'disk_cache': self.disk_cache.stats()})
+
+
+class TileRequestHandler(http.server.BaseHTTPRequestHandler):
+	''' Serves /colors/{z}/{x}/{y}.png (RGBA, with "No data" transparent),
+	    /labels/{z}/{x}/{y}.png (single-band label indices) and /stats '''
+	def do_GET(self):
+		parts = self.path.strip('/').split('/')
+		if parts == ['stats']:
+			self.send(json.dumps(self.server.tiles.stats()).encode(),
+					  'application/json')
+			return
+		try:
+			layer, z, x, y = parts[0], int(parts[1]), int(parts[2]), \
+				int(parts[3].replace('.png', ''))
+			assert layer in ('colors', 'labels') and \
+				parts[3].endswith('.png')
+			assert self.server.tiles.min_zoom <= z and 0 <= x < 2**z and \
+				0 <= y < 2**z
+		except (IndexError, ValueError, AssertionError):
+			self.send_error(404)
+			return
+
+		labels = self.server.tiles.get(z, x, y)
+		if layer == 'colors':
+			image = np.concatenate([
+				evaluate.colorize_labels(np.transpose(labels)),
+				np.where(labels > 0, 255, 0).astype(np.uint8)[:, :, np.newaxis]],
+				axis=2)
+		else:
+			image = labels
+		self.send(encode_png(image), 'image/png')
+		return
+
+	def send(self, body, content_type):
+		self.send_response(200)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		return
+
+
+def serve(tiles, port):
+	server = http.server.ThreadingHTTPServer(('localhost', port),
+											  TileRequestHandler)
+	server.tiles = tiles
+	print('Serving tiles at http://localhost:{}/colors/{{z}}/{{x}}/{{y}}.png'
+		  .format(port))
+	server.serve_forever()
+	return
+
+
+def fetch(url, bbox, zoom, layer='colors', output_dir=None):
+	''' Request every tile covering a (min_lat, min_lon, max_lat, max_lon)
+	    bounding box from a running server, as a map viewer would, and
+	    report the time taken for each. Tiles are saved to output_dir if
+	    given. '''
+	min_lat, min_lon, max_lat, max_lon = bbox
+	min_x, min_y = tile_from_latlon(max_lat, min_lon, zoom)
+	max_x, max_y = tile_from_latlon(min_lat, max_lon, zoom)
+	durations = []
+	for x in range(min_x, max_x + 1):
+		for y in range(min_y, max_y + 1):
+			start = time.perf_counter()
+			with urllib.request.urlopen('{}/{}/{}/{}/{}.png'.format(
+				url.rstrip('/'), layer, zoom, x, y)) as response:
+				body = response.read()
+			durations.append(time.perf_counter() - start)
+			if output_dir is not None:
+				os.makedirs(output_dir, exist_ok=True)
+				with open(os.path.join(output_dir, '{}_{}_{}.png'.format(
+					zoom, x, y)), 'wb') as f:
+					f.write(body)
+	print('Fetched {} tiles: mean {:.3f} s, max {:.3f} s'.format(
+		len(durations), np.mean(durations), np.max(durations)))
+	with urllib.request.urlopen(url.rstrip('/') + '/stats') as response:
+		print(response.read().decode())
+	return(durations)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='''
+Serves land cover predictions as XYZ map tiles, which GIS applications can
+display as a web tile layer. Tiles are labeled on first request from the NAIP
+tiles in a directory and cached in memory and on disk. The fetch command
+requests the tiles covering a bounding box from a running server.
+''')
+	subparsers = parser.add_subparsers(dest='command')
+
+	serve_parser = subparsers.add_parser('serve', help='Run the tile server')
+	serve_parser.add_argument('--tile_dir', type=str, required=True,
+							  help='Directory of NAIP tiles')
+	serve_parser.add_argument('-m', '--model_filename', type=str,
+							  required=True,
+							  help='Filepath to the trained model')
+	serve_parser.add_argument('--cache_dir', type=str, required=False,
+							  default='prediction_tiles',
+							  help='Directory for the on-disk tile cache')
+	serve_parser.add_argument('--memory_mb', type=float, required=False,
+							  default=512,
+							  help='Size of the in-memory tile cache, in MB')
+	serve_parser.add_argument('--disk_mb', type=float, required=False,
+							  default=8192,
+							  help='Size of the on-disk tile cache, in MB')
+	serve_parser.add_argument('--zoom', type=int, required=False, default=17,
+							  help='Zoom level at which tiles are labeled ' +
+							  '(17 is about 1 m per pixel)')
+	serve_parser.add_argument('--min_zoom', type=int, required=False,
+							  default=13,
+							  help='Lowest zoom level served, as overviews')
+	serve_parser.add_argument('--port', type=int, required=False,
+							  default=8080)
+	serve_parser.add_argument('-b', '--batch_size', type=int, required=False,
+							  default=16,
+							  help='Number of windows passed to the model ' +
+							  'per call')
+	serve_parser.add_argument('-w', '--window_dim', type=int, required=False,
+							  default=None,
+							  help='Side length of the windows passed to ' +
+							  'the model')
+	serve_parser.add_argument('--padding', type=int, required=False,
+							  default=None,
+							  help='Pixels dropped from each side of a ' +
+							  'window\'s prediction')
+
+	fetch_parser = subparsers.add_parser('fetch',
+		help='Request the tiles covering a bounding box from a server')
+	fetch_parser.add_argument('--url', type=str, required=False,
+							  default='http://localhost:8080')
+	fetch_parser.add_argument('--bbox', type=float, nargs=4, required=True,
+							  metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT',
+									   'MAX_LON'))
+	fetch_parser.add_argument('--zoom', type=int, required=False, default=17)
+	fetch_parser.add_argument('--layer', type=str, required=False,
+							  default='colors', choices=['colors', 'labels'])
+	fetch_parser.add_argument('-o', '--output_dir', type=str, required=False,
+							  default=None,
+							  help='Directory in which to save the tiles')
+	args = parser.parse_args()
+
+	if args.command == 'serve':
+		assert os.path.exists(args.model_filename), \
+			'Model file {} could not be accessed.'.format(args.model_filename)
+		assert args.min_zoom <= args.zoom, \
+			'The minimum zoom level cannot exceed the labeling zoom level.'
+		serve(PredictionTiles(args.tile_dir, args.model_filename,
+							  args.cache_dir, int(args.memory_mb * 2**20),
+							  int(args.disk_mb * 2**20), args.zoom,
+							  args.min_zoom, args.batch_size, args.window_dim,
+							  args.padding), args.port)
+	elif args.command == 'fetch':
+		fetch(args.url, args.bbox, args.zoom, args.layer, args.output_dir)
+	else:
+		parser.print_help()
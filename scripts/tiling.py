@@ -0,0 +1,119 @@
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+
+
+def resu_receptive_field(num_stack_layers=2):
+	''' Receptive field, in pixels, of the output of model_mini_pub.resu_model
+	    (125 pixels with the default two layers per stack). It is set by the
+	    deepest path: the first convolution, the full-resolution stack, three
+	    downsampling stages, the three stride-2 transposed convolutions back
+	    up (each output pixel of which depends on at most two input pixels)
+	    and the final 3x3 convolution. The mean of each color channel over
+	    the whole window, which the network subtracts, is not counted. '''
+	field, step = 1, 1
+	# (kernel size, stride) of the 3x3 convolutions on the deepest path
+	convolutions = [(3, 1)] * (1 + 2 * num_stack_layers)
+	for _ in range(3):
+		convolutions += [(3, 2)] + [(3, 1)] * (2 * num_stack_layers - 1)
+	for kernel, stride in convolutions:
+		field += (kernel - 1) * step
+		step *= stride
+	for _ in range(3):
+		field += step
+		step //= 2
+	return(field + 2 * step)
+
+
+class TilingPlan(object):
+	''' Covers a region with overlapping model windows.
+
+	    Each window is window_dim pixels on a side, and the model's prediction
+	    is kept only for the central output_dim = window_dim - 2 * padding
+	    pixels. The padding should be at least half of the model's receptive
+	    field, so that every kept pixel is labeled with the context the model
+	    was trained with. Output squares are laid edge to edge, except that
+	    the last one on each axis is shifted back to end flush with the
+	    region; windows reaching past the input are served by reflect-padding
+	    it (see crop_window). '''
+	def __init__(self, window_dim=256, padding=64, receptive_field=None):
+		self.window_dim = window_dim
+		self.padding = padding
+		self.output_dim = window_dim - 2 * padding
+		if padding < 0 or self.output_dim <= 0:
+			raise ValueError('A {}-pixel window has no output with {} pixels '
+							 'of padding on each side.'.format(window_dim,
+															   padding))
+		if receptive_field is not None and padding < receptive_field // 2:
+			raise ValueError('Padding of {} pixels is less than half of the '
+							 'receptive field ({} pixels).'.format(
+							 padding, receptive_field))
+
+	@classmethod
+	def for_model(cls, model):
+		''' The plan matching a model's input and output shapes '''
+		window_dim = model.arguments[0].shape[1]
+		output_dim = model.output.shape[1]
+		return(cls(window_dim, (window_dim - output_dim) // 2))
+
+	def starts(self, length):
+		''' Offsets of the output squares needed to cover one axis. A region
+		    shorter than output_dim gets one square, to be cropped. '''
+		starts = list(range(0, length - self.output_dim + 1, self.output_dim))
+		if length < self.output_dim:
+			starts = [0]
+		elif length % self.output_dim != 0:
+			starts.append(length - self.output_dim)
+		return(starts)
+
+	def offsets(self, height, width, row_order=False):
+		''' Offsets (x, y) of the output squares covering a region. With
+		    row_order, y (the raster row) varies slowest. '''
+		if row_order:
+			return([(x, y) for y in self.starts(width)
+						   for x in self.starts(height)])
+		return([(x, y) for x in self.starts(height)
+					   for y in self.starts(width)])
+
+	def grid_region(self, x, y, x_length, y_length):
+		''' The smallest region (x, y, x_length, y_length) made up of whole
+		    output squares, on a grid fixed at (0, 0), that contains the given
+		    region. Labeling it (and cropping the result) instead of the region
+		    itself means that overlapping regions are covered by identical
+		    windows, and that regions smaller than output_dim can be labeled.
+		    '''
+		x_start = x // self.output_dim * self.output_dim
+		y_start = y // self.output_dim * self.output_dim
+		x_end = -(-(x + x_length) // self.output_dim) * self.output_dim
+		y_end = -(-(y + y_length) // self.output_dim) * self.output_dim
+		return(x_start, y_start, x_end - x_start, y_end - y_start)
+
+	def overlap(self, height, width, x=None, y=None):
+		''' Ratio of the pixels passed through the model to those labeled.
+		    If the region's origin (x, y) is given, it is covered by the
+		    squares of its grid_region. '''
+		if x is None or y is None:
+			num_windows = len(self.starts(height)) * len(self.starts(width))
+		else:
+			_, _, grid_height, grid_width = self.grid_region(x, y, height,
+															 width)
+			num_windows = grid_height * grid_width // self.output_dim ** 2
+		return(num_windows * self.window_dim ** 2 / float(height * width))
+
+
+def crop_window(image, x, y, height, width):
+	''' Crop image[..., x:x + height, y:y + width], reflect-padding any part
+	    of the window that lies outside the image '''
+	x_dim, y_dim = image.shape[-2:]
+	x_start, x_end = min(max(x, 0), x_dim), max(min(x + height, x_dim), 0)
+	y_start, y_end = min(max(y, 0), y_dim), max(min(y + width, y_dim), 0)
+	window = image[..., x_start:x_end, y_start:y_end]
+	if (x_start, y_start, x_end, y_end) != (x, y, x + height, y + width):
+		window = np.pad(window, ((0, 0),) * (image.ndim - 2) +
+						((x_start - x, x + height - x_end),
+						 (y_start - y, y + width - y_end)), mode='reflect')
+	return(window)
@@ -6,57 +6,140 @@
 # ==============================================================================
 
 import numpy as np
-import pandas as pd
-import os, argparse, cntk, tifffile, model_mini_pub, warnings
+import os, argparse, cntk, model_mini_pub, json, functools, time
 import cntk.train.distributed as distributed
 from cntk.train.training_session import CheckpointConfig, training_session
-
-
-def load_image_pair(tile_name):
-	''' Load the corresponding NAIP and LandCover images '''
-	#with warnings.filterwarnings('ignore'):
-	# With the currently-available training data, the tifffile package
-	# generates these RuntimeWarnings and UserWarnings under normal
-	# operating conditions:
-	# - RuntimeWarning: py_decodelzw encountered unexpected end of stream
-	# - UserWarning: unpack: string size must be a multiple of element size
-	# - UserWarning: invalid tile data
-	with warnings.catch_warnings():
-		warnings.simplefilter('ignore')
-		naip_image = np.transpose(tifffile.imread(
-			'{}_NAIP.tif'.format(tile_name)))  / 256.0
-		landcover_image = np.transpose(tifffile.imread(
-			'{}_LandCover.tif'.format(tile_name)))
-	landcover_image[landcover_image > 4] = 4
+from prefetch import MinibatchPrefetcher, minibatch_rng
+from tile_scheduler import TileScheduler, assign_tiles
+from instrumentation import StageTimer, NullTimer
+from raster_io import read_image_pair, raster_size, naip_scale
+
+
+def load_shard_pair(tile_name):
+	''' Memory-map the NAIP and LandCover shards written by make_shards.py.
+	    Both are uint8; the NAIP image is rescaled when patches are cropped. '''
+	naip_image = np.load('{}_NAIP.npy'.format(tile_name), mmap_mode='r')
+	landcover_image = np.load('{}_LandCover.npy'.format(tile_name),
+							  mmap_mode='r')
 	return (naip_image, landcover_image)
 
 
-def get_cropped_data(image, bounds, rescale=False):
+def get_cropped_data(image, bounds, rescale=False, out=None):
 	''' Crop out a subsection of an NAIP or LandCover image. Note that NAIP
-	    images have an extra axis (for color), use rescale=True. '''
+	    images have an extra axis (for color), use rescale=True. NAIP images
+	    are kept as uint8 and are scaled by naip_scale as they are cropped. If
+	    out is given, the crop is written into it rather than a new array. '''
 	a, b, c, d = bounds
 	if rescale:
-		return(image[:, a : (a + c), b : (b + d)].astype(np.float32))
+		crop = image[:, a : (a + c), b : (b + d)]
+		if out is None:
+			out = np.empty(crop.shape, dtype=np.float32)
+		out[...] = crop
+		if image.dtype == np.uint8:
+			out *= naip_scale
+		return(out)
 	else:
-		return(image[a : (a + c), b : (b + d)].astype(np.int32))
-
-
-def interesting_patch(label_slice):
-	''' Upsample less common labels '''
-	w, h = label_slice.shape
-	return ((label_slice == 1).sum() + \
-			(label_slice == 4).sum() > 0.003 * w * h) \
-			or (np.random.random_sample() > 0.5)
+		crop = image[a : (a + c), b : (b + d)]
+		if out is None:
+			return(crop.astype(np.int32))
+		out[...] = crop
+		return(out)
+
+
+def labels_to_one_hot(labels, out):
+	''' Write the one-hot encoding of a batch of label images into out, which
+	    has the class as its second axis '''
+	for label_idx in range(out.shape[1]):
+		np.equal(labels, label_idx, out=out[:, label_idx])
+	return(out)
+
+
+def tile_pixel_count(tile_name):
+	''' Number of pixels in a NAIP image, read from the TIFF header only '''
+	width, height = raster_size('{}_NAIP.tif'.format(tile_name))
+	return(height * width)
+
+
+def rare_patch_mask(landcover_image, block_size, strip_width=2048):
+	''' Flag the patch offsets that contain enough of the less common labels
+	    (water and barren/impervious) to always be accepted for training.
+	    Entry [i, j] refers to the patch whose corner is at (i, j). The counts
+	    come from a summed-area table, built in column strips to bound the
+	    memory it needs. '''
+	w, h = landcover_image.shape
+	threshold = 0.003 * block_size * block_size
+	mask = np.zeros((w - block_size, h - block_size), dtype=bool)
+	for start in range(0, h - block_size, strip_width):
+		end = min(start + strip_width, h - block_size)
+		strip = landcover_image[:, start:end + block_size]
+		sat = np.zeros((w + 1, strip.shape[1] + 1), dtype=np.int32)
+		np.cumsum(np.cumsum((strip == 1) | (strip == 4), axis=0,
+							dtype=np.int32), axis=1, out=sat[1:, 1:])
+		counts = sat[block_size:-1, block_size:-1] \
+			- sat[:-block_size - 1, block_size:-1] \
+			- sat[block_size:-1, :-block_size - 1] \
+			+ sat[:-block_size - 1, :-block_size - 1]
+		mask[:, start:end] = counts > threshold
+	return(mask)
+
+
+def sample_patch_offsets(rare_mask, num_samples, rng):
+	''' Draw patch offsets, upsampling less common labels: a candidate is
+	    accepted if it is flagged in rare_mask, and otherwise with probability
+	    one half. Candidates are drawn and tested a batch at a time. Also
+	    returns the number of candidates rejected before the last accepted
+	    one used (as if candidates were tested one at a time). '''
+	w, h = rare_mask.shape
+	accepted_i, accepted_j = [], []
+	num_accepted, num_rejected = 0, 0
+	while num_accepted < num_samples:
+		num_candidates = 2 * (num_samples - num_accepted) + 4
+		i = rng.randint(0, w, size=num_candidates)
+		j = rng.randint(0, h, size=num_candidates)
+		keep = rare_mask[i, j] | (rng.random_sample(num_candidates) > 0.5)
+		accepted_i.append(i[keep])
+		accepted_j.append(j[keep])
+		kept = np.flatnonzero(keep)
+		if num_accepted + len(kept) >= num_samples:
+			# Candidates after the last one needed don't count
+			num_candidates = kept[num_samples - num_accepted - 1] + 1
+		num_rejected += num_candidates - np.count_nonzero(
+			keep[:num_candidates])
+		num_accepted += len(kept)
+	return(np.concatenate(accepted_i)[:num_samples],
+		   np.concatenate(accepted_j)[:num_samples], num_rejected)
 
 
 class MyDataSource(cntk.io.UserMinibatchSource):
 	''' A minibatch source for NAIP and label data '''
 	def __init__(self, f_dim, l_dim, number_of_workers, input_dir,
-		minibatches_per_image):
-		''' Divvy up images between workers at initialization '''
+		minibatches_per_image, prefetch_depth=4, prefetch_threads=2, seed=0,
+		tile_cache=None, tile_memory_budget=4 * 2**30, timer=None,
+		report_frequency=None):
+		''' Divvy up images between workers at initialization, balancing the
+		    number of pixels each worker samples from. Each worker cycles
+		    through all of its tiles, keeping as many in memory as fit within
+		    tile_memory_budget bytes (at least the current and next tiles;
+		    all of them if None). Minibatches are
+		    built on prefetch_threads background threads, up to
+		    prefetch_depth minibatches ahead of the trainer; a depth of zero
+		    builds them on the training thread instead. If a SharedTileCache
+		    is given, TIFF pairs are decoded through it so that workers on the
+		    same machine share one copy of each tile. If a StageTimer is
+		    given, each stage of minibatch creation is timed, and the timer
+		    reports every report_frequency minibatches. '''
 		# Record the image dimensions for later
 		self.f_dim, self.l_dim = f_dim, l_dim
 		self.minibatches_per_image = minibatches_per_image
+		self.prefetch_depth, self.prefetch_threads = prefetch_depth, \
+			prefetch_threads
+		self.seed = seed
+		self.tile_cache = tile_cache
+		self.tile_memory_budget = tile_memory_budget
+		self.timer = NullTimer() if timer is None else timer
+		self.report_frequency = report_frequency
+		self.last_return_time = None
+		self.first_return_time = None
 		self.num_color_channels, self.block_size, _ = self.f_dim
 		self.num_landcover_classes, _, _ = self.l_dim
 
@@ -66,35 +149,32 @@ class MyDataSource(cntk.io.UserMinibatchSource):
 		self.lsi = cntk.io.StreamInformation(
 			'labels', 1, 'dense', np.float32, self.l_dim)
 
-		# Create a transform for converting labels to one-hot
-		self.x = cntk.input_variable((self.block_size, self.block_size))
-		self.oh_tf = cntk.one_hot(self.x, self.num_landcover_classes, False,
-								  axis=0)
-
-		# Decide which tiles each worker will process
-		self.tile_names = {}
-		all_tiles = np.sort(
-			[os.path.join(input_dir, i.replace('_NAIP.tif', '')) \
-			 for i in os.listdir(input_dir) if i.endswith('_NAIP.tif')])
-		if number_of_workers > len(all_tiles):
-			for i in range(number_of_workers):
-				self.tile_names[i] = all_tiles[np.random.randint(
-					len(all_tiles), size=(2))]
+		# Decide which tiles each worker will process. If the input directory
+		# holds shards written by make_shards.py, they are memory-mapped
+		# instead of decoding the TIFFs.
+		index_filename = os.path.join(input_dir, 'index.json')
+		self.use_shards = os.path.exists(index_filename)
+		if self.use_shards:
+			with open(index_filename, 'r') as f:
+				tiles = sorted(json.load(f)['tiles'], key=lambda t: t['name'])
+			all_tiles = [os.path.join(input_dir, tile['name'])
+						 for tile in tiles]
+			tile_sizes = [tile['shape'][1] * tile['shape'][2]
+						  for tile in tiles]
 		else:
-			for i, tile_subset in enumerate(np.array_split(np.sort(all_tiles),
-														   number_of_workers)):
-				if len(tile_subset) > 5:
-					tile_subset = tile_subset[:5]
-				self.tile_names[i] = tile_subset
-
-
-		self.current_mb_indices = dict(zip(range(number_of_workers),
-										   [0] * number_of_workers))
-		self.current_image_indices = dict(zip(range(number_of_workers),
-										      [0] * number_of_workers))
-		self.naip_images = [[]] * number_of_workers
-		self.landcover_images = [[]] * number_of_workers
-		self.already_loaded_images = [False] * number_of_workers
+			all_tiles = sorted(
+				[os.path.join(input_dir, i.replace('_NAIP.tif', '')) \
+				 for i in os.listdir(input_dir) if i.endswith('_NAIP.tif')])
+			tile_sizes = [tile_pixel_count(tile_name)
+						  for tile_name in all_tiles]
+		self.tile_names = assign_tiles(all_tiles, tile_sizes,
+									   number_of_workers)
+
+		self.batch_indices = dict(zip(range(number_of_workers),
+									  [0] * number_of_workers))
+		self.prefetchers = {}
+		self.buffers = {}
+		self.schedulers = {}
 
 		super(MyDataSource, self).__init__()
 
@@ -105,68 +185,153 @@ class MyDataSource(cntk.io.UserMinibatchSource):
 		device=None):
 		''' Worker loads TIF images and extracts samples from them '''
 
-		if not self.already_loaded_images[worker_rank]:
-			# It's time to load all images into memory. This can take time, so
-			# we log our progress to stdout
-			self.already_loaded_images[worker_rank] = True
-			for i, tile_name in enumerate(self.tile_names[worker_rank]):
-				try:
-					naip_image, landcover_image = load_image_pair(tile_name)
-					self.naip_images[worker_rank].append(naip_image)
-					self.landcover_images[worker_rank].append(landcover_image)
-					print('Worker {} loaded its {}th image'.format(
-						worker_rank, i))
-				except ValueError:
-					print('Failed to load TIF pair: {}'.format(tile_name))
-					pass
-			print('Worker {} completed image loading'.format(worker_rank))
-
-		if self.current_mb_indices[worker_rank] == 0:
-			# It's time to advance the image index
-			self.current_image_indices[worker_rank] = (
-				self.current_image_indices[worker_rank] + 1) % len(
-				self.naip_images[worker_rank])
-		idx = self.current_image_indices[worker_rank]
-
-		# Feature data have dimensions: num_color_channels x block size 
-		#								x block size
-		# Label data have dimensions: block_size x block_size
-		features = np.zeros((mb_size_in_samples, self.num_color_channels,
-							 self.block_size, self.block_size),
-							dtype=np.float32)
-		labels = np.zeros((mb_size_in_samples, self.block_size,
-						   self.block_size), dtype=np.float32)
-
-		# Randomly select subsets of the image for training
-		w, h = self.naip_images[worker_rank][idx].shape[1:]
-		samples_retained = 0
-		while samples_retained < mb_size_in_samples:
-			i = np.random.randint(0, w - self.block_size)
-			j = np.random.randint(0, h - self.block_size)            
-			bounds = (i, j, self.block_size, self.block_size)
-			label_slice = get_cropped_data(
-				self.landcover_images[worker_rank][idx], bounds, False)
-			if interesting_patch(label_slice):
-				features[samples_retained, :, :, :] = get_cropped_data(
-					self.naip_images[worker_rank][idx], bounds, True)
-				labels[samples_retained, :, :] = label_slice
-				samples_retained += 1
-
-		# Convert the label data to one-hot, then convert arrays to Values
-		f_data = cntk.Value(batch=features)
-		l_data = cntk.Value(batch=self.oh_tf.eval({self.x: labels}))
+		if worker_rank not in self.schedulers:
+			# Tiles are loaded as they are needed, the next one in the
+			# background while the current one is sampled
+			self.schedulers[worker_rank] = TileScheduler(
+				self.tile_names[worker_rank], self.load_tile,
+				self.tile_memory_budget, worker_rank)
+
+		# Time spent by the trainer since the last minibatch was returned:
+		# the forward and backward passes, all-reduce, and parameter update
+		if self.last_return_time is not None:
+			self.timer.add('train_step',
+						   time.perf_counter() - self.last_return_time)
+
+		batch_index = self.batch_indices[worker_rank]
+		if self.prefetch_depth > 0:
+			# Prefetchers are tied to a minibatch size, so start a new one
+			# (continuing from the same batch index) if the size changes
+			mb_size, prefetcher = self.prefetchers.get(worker_rank, (0, None))
+			if mb_size != mb_size_in_samples:
+				if prefetcher is not None:
+					prefetcher.stop()
+				self.allocate_buffers(worker_rank, mb_size_in_samples,
+					MinibatchPrefetcher.max_batches_in_flight(
+						self.prefetch_threads, self.prefetch_depth))
+				prefetcher = MinibatchPrefetcher(
+					functools.partial(self.make_minibatch, worker_rank,
+									  mb_size_in_samples),
+					self.seed, worker_rank, batch_index,
+					self.prefetch_threads, self.prefetch_depth)
+				self.prefetchers[worker_rank] = (mb_size_in_samples, prefetcher)
+			with self.timer.time('prefetch_wait'):
+				features, labels = prefetcher.next()
+		else:
+			if self.buffers.get(worker_rank, (0,))[0] != mb_size_in_samples:
+				self.allocate_buffers(worker_rank, mb_size_in_samples, 1)
+			features, labels = self.make_minibatch(worker_rank,
+				mb_size_in_samples, batch_index,
+				minibatch_rng(self.seed, worker_rank, batch_index))
+
+		# Convert arrays to Values. The Values hold copies, so the buffers can
+		# be reused for later minibatches.
+		with self.timer.time('transfer'):
+			f_data = cntk.Value(batch=features, device=device)
+			l_data = cntk.Value(batch=labels, device=device)
 
 		result = {self.fsi: cntk.io.MinibatchData(
 						f_data, mb_size_in_samples, mb_size_in_samples, False),
 				  self.lsi: cntk.io.MinibatchData(
 				  		l_data, mb_size_in_samples, mb_size_in_samples, False)}
 		
-		# Minibatch collection complete: update minibatch index so we know
-		# how many more minibatches to collect using this TIFF pair
-		self.current_mb_indices[worker_rank] = (1 + 
-			self.current_mb_indices[worker_rank]) % self.minibatches_per_image
+		# Minibatch collection complete: update the minibatch index, which
+		# also determines how many more minibatches to collect using this
+		# TIFF pair
+		self.batch_indices[worker_rank] = batch_index + 1
+		self.timer.count('minibatches')
+		self.timer.count('samples', mb_size_in_samples)
+		if self.report_frequency is not None and \
+			(batch_index + 1) % self.report_frequency == 0:
+			self.timer.report()
+		self.last_return_time = time.perf_counter()
+		if self.first_return_time is None:
+			self.first_return_time = self.last_return_time
 		return(result)
 
+	def get_checkpoint_state(self):
+		''' Workers take minibatches in lockstep, so one batch index (with
+		    the seed) determines every worker's tile, its position within
+		    the tile, and its random number generator '''
+		return({'batch_index': max(self.batch_indices.values()),
+				'seed': self.seed})
+
+	def restore_from_checkpoint(self, state):
+		''' Resume from a checkpointed batch index. Minibatches prefetched
+		    from the old position are discarded. Tiles are loaded on demand,
+		    so only those used from the restored position on are read. '''
+		for _, prefetcher in self.prefetchers.values():
+			prefetcher.stop()
+		self.prefetchers = {}
+		self.seed = int(state['seed'])
+		for worker_rank in self.batch_indices:
+			self.batch_indices[worker_rank] = int(state['batch_index'])
+		self.last_return_time = None
+		return
+
+	def load_tile(self, tile_name):
+		''' Load a tile pair and flag the patches with less common labels '''
+		with self.timer.time('decode'):
+			if self.use_shards:
+				naip_image, landcover_image = load_shard_pair(tile_name)
+			elif self.tile_cache is not None:
+				naip_image, landcover_image = self.tile_cache.load(tile_name)
+			else:
+				naip_image, landcover_image = read_image_pair(tile_name)
+		with self.timer.time('rare_mask'):
+			rare_mask = rare_patch_mask(landcover_image, self.block_size)
+		return(naip_image, landcover_image, rare_mask)
+
+	def allocate_buffers(self, worker_rank, mb_size_in_samples, num_slots):
+		''' Preallocate ring buffers holding num_slots minibatches '''
+		# Feature data have dimensions: num_color_channels x block size 
+		#								x block size
+		# Label data have dimensions: block_size x block_size, and are
+		# expanded to num_landcover_classes x block_size x block_size one-hot
+		features = np.zeros((num_slots, mb_size_in_samples,
+							 self.num_color_channels, self.block_size,
+							 self.block_size), dtype=np.float32)
+		labels = np.zeros((num_slots, mb_size_in_samples, self.block_size,
+						   self.block_size), dtype=np.uint8)
+		one_hot = np.zeros((num_slots, mb_size_in_samples,
+							self.num_landcover_classes, self.block_size,
+							self.block_size), dtype=np.float32)
+		self.buffers[worker_rank] = (mb_size_in_samples, features, labels,
+									 one_hot)
+		return
+
+	def make_minibatch(self, worker_rank, mb_size_in_samples, batch_index,
+		rng):
+		''' Randomly select subsets of an image for training. Each image
+		    supplies minibatches_per_image consecutive minibatches. The
+		    features and one-hot labels are written into the ring buffer slot
+		    for this batch index. '''
+		naip_image, landcover_image, rare_mask = self.schedulers[
+			worker_rank].get(batch_index // self.minibatches_per_image)
+		_, features, labels, one_hot = self.buffers[worker_rank]
+		slot = batch_index % len(features)
+		features, labels, one_hot = features[slot], labels[slot], one_hot[slot]
+
+		# Only the accepted patches are cropped
+		with self.timer.time('sampling'):
+			patch_i, patch_j, num_rejected = sample_patch_offsets(
+				rare_mask, mb_size_in_samples, rng)
+		self.timer.count('rejected_patches', int(num_rejected))
+		with self.timer.time('crop'):
+			for k, (i, j) in enumerate(zip(patch_i, patch_j)):
+				bounds = (i, j, self.block_size, self.block_size)
+				get_cropped_data(naip_image, bounds, True, out=features[k])
+				get_cropped_data(landcover_image, bounds, False, out=labels[k])
+		with self.timer.time('one_hot'):
+			labels_to_one_hot(labels, one_hot)
+		return(features, one_hot)
+
+	def prefetch_stats(self, worker_rank):
+		''' Stall counters for a worker's minibatch prefetcher, if any '''
+		if worker_rank not in self.prefetchers:
+			return(None)
+		return(self.prefetchers[worker_rank][1].stats())
+
 
 def center_square(output, block_size, padding):
 	return(cntk.slice(cntk.slice(output, 1, padding, block_size - padding),
@@ -186,12 +351,101 @@ def criteria(label, output, block_size, c_classes, weights):
 	return(mean_ce, pe)
 
 
-def train(input_dir, output_dir, num_epochs):
-	''' Coordinates model creation and training; minibatch creation '''
+def build_network(num_landcover_classes, num_color_channels, block_size,
+	num_stack_layers, c_map, padding=None):
+	''' Define the input variables, model, loss function and metric. The
+	    loss is computed on the central block_size - 2 * padding pixels of
+	    each patch (by default, the central half). '''
+	if padding is None:
+		padding = block_size // 4
+	f_dim = (num_color_channels, block_size, block_size)
+	l_dim = (num_landcover_classes, block_size, block_size)
+	feature = cntk.input_variable(f_dim, np.float32)
+	label = cntk.input_variable(l_dim, np.float32)
+
+	# Define the model
+	model = model_mini_pub.model(num_landcover_classes, block_size,
+								 num_stack_layers, c_map)(feature)
+
+	# Define the loss function and metric. Note that loss is not computed
+	# directly on the model's output; the edges are first dropped.
+	output = center_square(cntk.reshape(model,
+						   				(num_landcover_classes, block_size,
+						   				 block_size)),
+						   block_size, padding)
+	label_center = center_square(label, block_size, padding)
+	mean_ce, pe = criteria(label_center, output, block_size,
+						   num_landcover_classes, [0.0, 1.0, 1.0, 1.0, 1.0])
+	return(feature, label, model, output, mean_ce, pe)
+
+
+def learning_rate_scale(effective_batch_size, reference_batch_size, rule):
+	''' Factor applied to the per-sample learning rate when each update
+	    combines effective_batch_size samples instead of the
+	    reference_batch_size the schedule was tuned for. Gradients are summed
+	    over a minibatch, so an unchanged per-sample rate makes the step grow
+	    in proportion to the batch ('linear'); 'sqrt' grows it with the square
+	    root of the batch, and 'none' keeps the step the same. '''
+	ratio = reference_batch_size / float(effective_batch_size)
+	return({'linear': 1.0, 'sqrt': np.sqrt(ratio), 'none': ratio}[rule])
+
+
+def create_learner(model, minibatch_size, epoch_size, lr_scale=1.0):
+	''' Define the learner and its learning rate schedule '''
+	lr_per_mb = [0.0001] * 30 + [0.00001] * 30 + [0.000001]
+	lr_per_sample = [lr * lr_scale / minibatch_size for lr in lr_per_mb]
+	lr_schedule = cntk.learning_rate_schedule(lr_per_sample,
+											  epoch_size=epoch_size,
+											  unit=cntk.UnitType.sample)
+	return(cntk.rmsprop(model.parameters, lr_schedule, 0.95, 1.1, 0.9, 1.1,
+						0.9, l2_regularization_weight=0.00001))
+
+
+def create_distributed_learner(learner, distribution, number_of_workers,
+	samples_per_step, quantization_bits=32, sync_period=8):
+	''' Wrap a learner for training on several workers.
+	    - 'data_parallel' all-reduces the gradients after every minibatch,
+	      optionally quantized to quantization_bits (1 for 1-bit SGD, which
+	      needs a CNTK build that includes it)
+	    - 'block_momentum' lets each worker train on its own for sync_period
+	      minibatches, then applies the averaged change in the parameters
+	      with block momentum (blockwise model update and filtering)
+	    - 'local_sgd' averages the workers' parameters every sync_period
+	      minibatches, without block momentum '''
+	if distribution == 'data_parallel':
+		return(distributed.data_parallel_distributed_learner(
+			learner, num_quantization_bits=quantization_bits))
+
+	# CNTK's block size counts the samples processed by all workers
+	block_size = samples_per_step * sync_period * number_of_workers
+	if distribution == 'block_momentum':
+		# The default time constant gives a block momentum of
+		# 1 - 1 / number_of_workers
+		return(distributed.block_momentum_distributed_learner(
+			learner, block_size=block_size))
+	return(distributed.block_momentum_distributed_learner(
+		learner, block_size=block_size, block_momentum_as_time_constant=0))
+
+
+def train(input_dir, output_dir, num_epochs, prefetch_depth=4,
+	prefetch_threads=2, tile_cache_dir=None, tile_cache_gb=16,
+	tile_memory_gb=4, instrument=False, profile=False, block_size=256,
+	num_stack_layers=2, c_map=(64, 32, 32, 32), minibatches_per_epoch=1600,
+	padding=None, distribution='data_parallel', quantization_bits=32,
+	sync_period=8, accumulation_steps=1, lr_scaling='linear'):
+	''' Coordinates model creation and training; minibatch creation.
+	    Each worker draws accumulation_steps * 10 samples per training step
+	    (CNTK's Trainer cannot carry gradients across calls, so they are
+	    processed as one minibatch). The learning rate is scaled for the
+	    number of samples combined in each update according to lr_scaling:
+	    across all workers for 'data_parallel', and on each worker for
+	    'block_momentum' and 'local_sgd', whose block updates take care of
+	    the number of workers. Returns this worker's startup time (until its
+	    first minibatch was ready) and training time (from then on), in
+	    seconds. '''
+	start_time = time.perf_counter()
 	num_landcover_classes = 5
 	num_color_channels = 4
-	block_size = 256
-	padding = int(block_size / 4)
 
 	my_rank = distributed.Communicator.rank()
 	number_of_workers = distributed.Communicator.num_workers()
@@ -201,35 +455,45 @@ def train(input_dir, output_dir, num_epochs):
 	# the next image file. Our epoch size is 16,000 samples.
 	minibatch_size = 10
 	minibatches_per_image = 160
-	minibatches_per_epoch = 1600
 	epoch_size = minibatch_size * minibatches_per_epoch
+	samples_per_step = minibatch_size * accumulation_steps
+	effective_batch_size = samples_per_step
+	if distribution == 'data_parallel':
+		effective_batch_size *= number_of_workers
 
-	# Define the input variables
-	f_dim = (num_color_channels, block_size, block_size)
-	l_dim = (num_landcover_classes, block_size, block_size)
-	feature = cntk.input_variable(f_dim, np.float32)
-	label = cntk.input_variable(l_dim, np.float32)
+	# Define the input variables, model, loss function and metric
+	feature, label, model, output, mean_ce, pe = build_network(
+		num_landcover_classes, num_color_channels, block_size,
+		num_stack_layers, list(c_map), padding)
+	f_dim, l_dim = feature.shape, label.shape
 
 	# Define the minibatch source
+	timer = None
+	if instrument:
+		timer = StageTimer(os.path.join(
+			output_dir, 'instrumentation_rank{}.jsonl'.format(my_rank)),
+			my_rank)
+	# The epoch size counts the samples of all workers, so each worker
+	# returns epoch_size / (number_of_workers * samples_per_step) minibatches
+	# per epoch
+	minibatches_per_worker_epoch = max(1, epoch_size // (number_of_workers *
+														  samples_per_step))
+	tile_cache = None
+	if tile_cache_dir is not None:
+		from tile_cache import SharedTileCache
+		tile_cache = SharedTileCache(read_image_pair, tile_cache_dir,
+									 int(tile_cache_gb * 2**30))
 	minibatch_source = MyDataSource(f_dim, l_dim, number_of_workers, input_dir,
-									minibatches_per_image)
+									minibatches_per_image, prefetch_depth,
+									prefetch_threads, tile_cache=tile_cache,
+									tile_memory_budget=None if tile_memory_gb
+									is None else int(tile_memory_gb * 2**30),
+									timer=timer,
+									report_frequency=
+									minibatches_per_worker_epoch)
 	input_map = {feature: minibatch_source.streams.features,
 				 label: minibatch_source.streams.labels}
 
-	# Define the model
-	model = model_mini_pub.model(num_landcover_classes, block_size,
-								 2, [64, 32, 32, 32])(feature)
-
-	# Define the loss function and metric. Note that loss is not computed
-	# directly on the model's output; the edges are first dropped.
-	output = center_square(cntk.reshape(model,
-						   				(num_landcover_classes, block_size,
-						   				 block_size)),
-						   block_size, padding)
-	label_center = center_square(label, block_size, padding)
-	mean_ce, pe = criteria(label_center, output, block_size,
-						   num_landcover_classes, [0.0, 1.0, 1.0, 1.0, 1.0])
-
 	# Create the progress writer, learner, and trainer (which will be a
 	# distributed trainer if number_of_workers > 1)
 	progress_writers = [cntk.logging.progress_print.ProgressPrinter(
@@ -238,17 +502,14 @@ def train(input_dir, output_dir, num_epochs):
 		freq=epoch_size,
 		rank=my_rank)]
 
-	lr_per_mb = [0.0001] * 30 + [0.00001] * 30 + [0.000001]
-	lr_per_sample = [lr / minibatch_size for lr in lr_per_mb]
-	lr_schedule = cntk.learning_rate_schedule(lr_per_sample,
-											  epoch_size=epoch_size,
-											  unit=cntk.UnitType.sample)
-	learner = cntk.rmsprop(model.parameters, lr_schedule, 0.95, 1.1, 0.9, 1.1,
-						   0.9, l2_regularization_weight=0.00001)
+	learner = create_learner(model, minibatch_size, epoch_size,
+							 learning_rate_scale(effective_batch_size,
+												 minibatch_size, lr_scaling))
 
 	if number_of_workers > 1:
-		parameter_learner = distributed.data_parallel_distributed_learner(
-			learner, num_quantization_bits=32)
+		parameter_learner = create_distributed_learner(learner, distribution,
+			number_of_workers, samples_per_step, quantization_bits,
+			sync_period)
 		trainer = cntk.Trainer(output, (mean_ce, pe), parameter_learner,
 							   progress_writers)
 	else:
@@ -259,14 +520,22 @@ def train(input_dir, output_dir, num_epochs):
 	if my_rank == 0:
 		print('Retraining model for {} epochs.'.format(num_epochs))
 		print('Found {} workers'.format(number_of_workers))
+		if number_of_workers > 1:
+			print('Distributing training with {} ({} samples per update, '
+				  '{} learning rate scaling)'.format(distribution,
+				  effective_batch_size, lr_scaling))
 		print('Printing progress every {} minibatches'.format(
 			minibatches_per_epoch))
 		cntk.logging.progress_print.log_number_of_parameters(model)
+	if profile:
+		import cProfile
+		profiler = cProfile.Profile()
+		profiler.enable()
 	training_session(
 		trainer=trainer,
 		max_samples=num_epochs * epoch_size,
 		mb_source=minibatch_source, 
-		mb_size=minibatch_size,
+		mb_size=samples_per_step,
 		model_inputs_to_streams=input_map,
 		checkpoint_config=CheckpointConfig(
 			frequency=epoch_size,
@@ -274,12 +543,29 @@ def train(input_dir, output_dir, num_epochs):
 			preserve_all=True),
 		progress_frequency=epoch_size
 	).train()
+	end_time = time.perf_counter()
+	if profile:
+		# Note that only the training thread is profiled, not the threads
+		# that prefetch minibatches
+		profiler.disable()
+		profiler.dump_stats(os.path.join(output_dir,
+										 'profile_rank{}.prof'.format(my_rank)))
+
+	stats = minibatch_source.prefetch_stats(my_rank)
+	if stats is not None:
+		print('Worker {} waited {:.1f} s for {} prefetched minibatches; '
+			  'producers were blocked on a full queue for {:.1f} s'.format(
+			  my_rank, stats['consumer_wait_seconds'],
+			  stats['batches_consumed'], stats['producer_wait_seconds']))
 
 	distributed.Communicator.finalize() 
 	if my_rank == 0:
 		trainer.model.save(os.path.join(output_dir,
 										'trained.model'))
-	return
+	return({'startup_seconds':
+			minibatch_source.first_return_time - start_time,
+			'training_seconds':
+			end_time - minibatch_source.first_return_time})
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='''
@@ -302,6 +588,64 @@ load a checkpoint from this directory if a checkpoint is found there).
 						default=1,
 						help='Specifies the number of epochs of training to ' +
 						'be performed.')
+	parser.add_argument('--prefetch_depth', type=int, required=False,
+						default=4,
+						help='Number of minibatches to build ahead of the ' +
+						'trainer (0 builds them on the training thread).')
+	parser.add_argument('--prefetch_threads', type=int, required=False,
+						default=2,
+						help='Number of threads building minibatches.')
+	parser.add_argument('--tile_cache_dir', type=str, required=False,
+						default=None,
+						help='Node-local directory (e.g. /dev/shm/tiles) in ' +
+						'which decoded tiles are shared by all workers on a ' +
+						'machine. By default each worker decodes its own. ' +
+						'A directory on persistent local disk keeps the ' +
+						'decoded tiles for a resumed job.')
+	parser.add_argument('--tile_cache_gb', type=float, required=False,
+						default=16,
+						help='Memory budget for the tile cache, in GB.')
+	parser.add_argument('--tile_memory_gb', type=float, required=False,
+						default=4,
+						help='Memory budget for the tiles each worker keeps ' +
+						'loaded, in GB. The least recently used tiles are ' +
+						'dropped beyond it, but the current and next tiles ' +
+						'are always kept.')
+	parser.add_argument('--instrument', action='store_true',
+						help='Time each stage of the input pipeline and the ' +
+						'training step, writing one JSON line per epoch ' +
+						'per worker to the model directory.')
+	parser.add_argument('--profile', action='store_true',
+						help='Save a cProfile dump per worker to the model ' +
+						'directory.')
+	parser.add_argument('--distribution', type=str, required=False,
+						default='data_parallel',
+						choices=['data_parallel', 'block_momentum',
+								 'local_sgd'],
+						help='How workers combine their updates: ' +
+						'all-reduce gradients after every minibatch, or ' +
+						'train independently and combine parameters every ' +
+						'--sync_period minibatches with or without block ' +
+						'momentum.')
+	parser.add_argument('--quantization_bits', type=int, required=False,
+						default=32,
+						help='Bits per gradient value exchanged with ' +
+						'data_parallel distribution (1 for 1-bit SGD, which ' +
+						'requires a CNTK build that includes it).')
+	parser.add_argument('--sync_period', type=int, required=False,
+						default=8,
+						help='Minibatches each worker trains on between ' +
+						'parameter exchanges with block_momentum or ' +
+						'local_sgd distribution.')
+	parser.add_argument('--accumulation_steps', type=int, required=False,
+						default=1,
+						help='Multiple of 10 samples each worker trains on ' +
+						'per step, to raise the batch size and reduce the ' +
+						'frequency of communication.')
+	parser.add_argument('--lr_scaling', type=str, required=False,
+						default='linear', choices=['linear', 'sqrt', 'none'],
+						help='How the step size grows with the number of ' +
+						'samples per update.')
 	args = parser.parse_args()
 
 	assert os.path.exists(args.input_dir), \
@@ -310,4 +654,21 @@ load a checkpoint from this directory if a checkpoint is found there).
 	assert args.num_epochs > 0, \
 		'The number of epochs must be greater than zero'
 
-	train(args.input_dir, args.model_dir, args.num_epochs)
\ No newline at end of file
+	assert args.prefetch_depth >= 0 and args.prefetch_threads > 0, \
+		'Prefetch depth must be non-negative and thread count positive'
+	assert args.quantization_bits == 32 or \
+		args.distribution == 'data_parallel', \
+		'Gradient quantization applies only to data_parallel distribution'
+	assert 1 <= args.quantization_bits <= 32, \
+		'The number of quantization bits must be between 1 and 32'
+	assert args.sync_period > 0 and args.accumulation_steps > 0, \
+		'Sync period and accumulation steps must be greater than zero'
+
+	train(args.input_dir, args.model_dir, args.num_epochs, args.prefetch_depth,
+		  args.prefetch_threads, args.tile_cache_dir, args.tile_cache_gb,
+		  args.tile_memory_gb, args.instrument, args.profile,
+		  distribution=args.distribution,
+		  quantization_bits=args.quantization_bits,
+		  sync_period=args.sync_period,
+		  accumulation_steps=args.accumulation_steps,
+		  lr_scaling=args.lr_scaling)
\ No newline at end of file